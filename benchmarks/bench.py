@@ -0,0 +1,419 @@
+#!/usr/bin/python3
+# vim: set et sw=4 ts=4:
+
+# Benchmark sis2calgroups against a local stand-in for the SIS and Grouper
+# APIs. Synthetic courses are served with configurable size, pagination,
+# section count, latency and error rate, and each course sync is timed.
+#
+#   PYTHONPATH=. python benchmarks/bench.py --courses 20 --students 800 \
+#       --latency 0.02
+#
+# from the top of a checkout, or without PYTHONPATH after pip install -e .
+
+import argparse
+import collections
+import functools
+import gzip
+import http.server
+import json
+import logging
+import random
+import re
+import resource
+import sys
+import threading
+import time
+import tracemalloc
+import urllib.parse
+
+import sis2calgroups.__main__ as cli
+from sis2calgroups import grouper, ratelimit, sis
+
+logging.basicConfig(stream=sys.stdout, level=logging.WARNING)
+logger = logging.getLogger('bench')
+
+subject_area = 'bench'
+term_id = '2192'
+
+class Catalog:
+    '''Synthetic courses, their sections and enrollments, and the state of
+       the stand-in Grouper.'''
+
+    def __init__(self, courses, students, sections, seed=0):
+        rng = random.Random(seed)
+        self.courses = {}
+        section_id = 10000
+        for n in range(1, courses + 1):
+            catalog_number = str(n)
+            course_sections = []
+            for s in range(sections):
+                section_id += 1
+                course_sections.append({
+                    'id': section_id,
+                    'number': f'{s + 1:03d}',
+                    'component': {'code': 'LEC' if s == 0 else 'LAB'},
+                    'association': {'primary': s == 0},
+                    'class': {'course': {'catalogNumber':
+                        {'formatted': catalog_number}}},
+                    'meetings': [{'assignedInstructors': [{'instructor': {
+                        'identifiers': [{'disclose': True,
+                            'type': 'campus-uid',
+                            'id': str(900000 + section_id)}]
+                    }}]}],
+                })
+            enrollments = []
+            for i in range(students):
+                uid = str(100000 + n * students + i)
+                status = rng.choice('EEEEEEEEWD')
+                enrollments.append({
+                    'student': {
+                        'identifiers': [{'type': 'campus-uid', 'id': uid}],
+                        'emails': [{'type': {'code': 'CAMP'},
+                            'emailAddress': f'{uid}@example.edu'}],
+                    },
+                    'enrollmentStatus': {'status': {'code': status}},
+                    'classSection': {'id': course_sections[
+                        i % len(course_sections)]['id']},
+                })
+            self.courses[catalog_number] = {
+                'sections': course_sections, 'enrollments': enrollments}
+        self.sections = {s['id']: (catalog_number, s)
+            for catalog_number, c in self.courses.items()
+            for s in c['sections']}
+        self.members = collections.defaultdict(set)
+
+class Handler(http.server.BaseHTTPRequestHandler):
+    '''Serve the SIS enrollments, classes and terms endpoints and the
+       Grouper stems, groups and members endpoints.'''
+
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        self.handle_request('GET')
+
+    def do_POST(self):
+        self.handle_request('POST')
+
+    def do_PUT(self):
+        self.handle_request('PUT')
+
+    def handle_request(self, method):
+        server = self.server
+        url = urllib.parse.urlparse(self.path)
+        params = dict(urllib.parse.parse_qsl(url.query))
+        length = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(length) if length else b''
+        with server.lock:
+            server.requests += 1
+            server.bytes_in += len(body)
+        if self.headers.get('Content-Encoding') == 'gzip':
+            body = gzip.decompress(body)
+        time.sleep(server.latency)
+        if server.rng.random() < server.error_rate:
+            return self.reply(503, {'error': 'injected'})
+        try:
+            if url.path.startswith('/sis/'):
+                status, data = self.sis(url.path, params)
+            else:
+                data = json.loads(body) if body else {}
+                status, data = self.grouper(method, url.path, data)
+        except Exception as e:
+            logger.exception(e)
+            status, data = 500, {'error': str(e)}
+        self.reply(status, data)
+
+    def reply(self, status, data):
+        body = json.dumps(data).encode()
+        with self.server.lock:
+            self.server.bytes_out += len(body)
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def page(self, items, params, default_size):
+        if 'page-number' not in params:
+            return items
+        size = int(params.get('page-size', default_size))
+        if self.server.page_size:
+            size = min(size, self.server.page_size)
+        start = (int(params['page-number']) - 1) * size
+        return items[start:start + size]
+
+    def sis(self, path, params):
+        catalog = self.server.catalog
+
+        def response(item_type, items):
+            if not items:
+                return 404, {'apiResponse': {}}
+            return 200, {'apiResponse': {'response': {item_type: items}}}
+
+        if path.endswith('/descriptors'):
+            course = catalog.courses.get(params.get('catalog-number'))
+            sections = course['sections'] if course else []
+            values = [{'code': str(s['id']), 'description':
+                f"2019 Spring {subject_area.upper()} {s['number']} "
+                f"{s['component']['code']} {s['number']}"}
+                for s in sections]
+            return response('fieldValues', self.page(values, params, 100))
+        m = re.search(r'/classes/sections/(\d+)$', path)
+        if m and '/enrollments/' in path:
+            section_id = int(m.group(1))
+            catalog_number, section = catalog.sections[section_id]
+            enrollments = [e for e in
+                catalog.courses[catalog_number]['enrollments']
+                if section['association']['primary'] or
+                    e['classSection']['id'] == section_id]
+            return response('classSectionEnrollments',
+                self.page(enrollments, params, 100))
+        if path.endswith('/classes/sections'):
+            if 'catalog-number' in params:
+                course = catalog.courses.get(params['catalog-number'])
+                sections = course['sections'] if course else []
+            else:
+                sections = [s for c in catalog.courses.values()
+                    for s in c['sections']]
+            return response('classSections', self.page(sections, params, 100))
+        if '/terms' in path:
+            return response('terms', [{'id': term_id, 'name': '2019 Spring',
+                'endDate': '2099-05-17'}])
+        return 404, {}
+
+    def grouper(self, method, path, data):
+        members = self.server.catalog.members
+        path = path[len('/grouper/'):]
+        if path == 'stems' and 'WsRestStemSaveRequest' in data:
+            saves = data['WsRestStemSaveRequest']['wsStemToSaves']
+            return 200, {'WsStemSaveResults': {'results': [
+                {'resultMetadata': {'resultCode': 'SUCCESS_INSERTED'}}
+                for s in saves]}}
+        if path == 'groups' and 'WsRestGroupSaveRequest' in data:
+            saves = data['WsRestGroupSaveRequest']['wsGroupToSaves']
+            return 200, {'WsGroupSaveResults': {'results': [
+                {'resultMetadata': {'resultCode': 'SUCCESS_INSERTED'}}
+                for s in saves]}}
+        if path == 'groups' and 'WsRestGetMembersRequest' in data:
+            request = data['WsRestGetMembersRequest']
+            group = request['wsGroupLookups'][0]['groupName']
+            return 200, {'WsGetMembersResults': {'results': [{
+                'resultMetadata': {'resultCode': 'SUCCESS'},
+                'wsSubjects': [{'id': uid, 'sourceId': 'ldap'}
+                    for uid in sorted(members[group])]}]}}
+        m = re.match(r'groups/(.+)/members$', path)
+        if m:
+            group = m.group(1)
+            if 'WsRestAddMemberRequest' in data:
+                request = data['WsRestAddMemberRequest']
+                uids = set(s.get('subjectId') or s.get('subjectIdentifier')
+                    for s in request['subjectLookups'])
+                if request.get('replaceAllExisting') == 'T':
+                    members[group] = uids
+                else:
+                    members[group] |= uids
+                return 200, {'WsAddMemberResults': {'resultMetadata':
+                    {'resultCode': 'SUCCESS'}}}
+            if 'WsRestDeleteMemberRequest' in data:
+                request = data['WsRestDeleteMemberRequest']
+                members[group] -= set(s.get('subjectId')
+                    for s in request['subjectLookups'])
+                return 200, {'WsDeleteMemberResults': {'resultMetadata':
+                    {'resultCode': 'SUCCESS'}}}
+        if path.startswith('stems/'):
+            return 200, {'WsStemSaveLiteResult': {'resultMetadata':
+                {'resultCode': 'SUCCESS_INSERTED'}}}
+        if path.startswith('groups/'):
+            return 200, {'WsGroupSaveLiteResult': {'resultMetadata':
+                {'resultCode': 'SUCCESS_INSERTED'}}}
+        return 404, {'WsRestResultProblem': {'resultMetadata':
+            {'resultMessage': f'unknown request {method} {path}'}}}
+
+class MockServer(http.server.ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, catalog, latency=0, error_rate=0, page_size=None,
+        seed=0):
+        super().__init__(('127.0.0.1', 0), Handler)
+        self.catalog = catalog
+        self.page_size = page_size
+        self.latency = latency
+        self.error_rate = error_rate
+        self.rng = random.Random(seed)
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.requests = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+
+    @property
+    def uri(self):
+        return f'http://127.0.0.1:{self.server_address[1]}'
+
+    def start(self):
+        thread = threading.Thread(target=self.serve_forever, daemon=True)
+        thread.start()
+        return self
+
+def point_at(uri):
+    '''Direct the sis and grouper modules at the mock server.'''
+    sis.enrollments_uri = uri + '/sis/v2/enrollments'
+    sis.descriptors_uri = sis.enrollments_uri + \
+        '/terms/{}/classes/sections/descriptors'
+    sis.sections_uri = sis.enrollments_uri + '/terms/{}/classes/sections/{}'
+    sis.classes_sections_uri = uri + '/sis/v1/classes/sections'
+    sis.terms_uri = uri + '/sis/v1/terms'
+    grouper.base_uri = uri + '/grouper'
+
+def percentile(values, p):
+    values = sorted(values)
+    if not values:
+        return 0
+    return values[min(len(values) - 1, int(round(p * (len(values) - 1))))]
+
+def run(mode, server, courses, credentials, workers, trace_memory=False):
+    '''Sync every course once and return per-course latencies, failures
+       and the peak memory in bytes. Memory is the peak traced by
+       tracemalloc if {trace_memory}, which slows the run, and otherwise the
+       peak resident size of the process.'''
+    latencies = []
+    lock = threading.Lock()
+
+    def timed(sync):
+        def timed_sync(subject_area, catalog_number):
+            start = time.perf_counter()
+            try:
+                return sync(subject_area, catalog_number)
+            finally:
+                with lock:
+                    latencies.append(time.perf_counter() - start)
+        return timed_sync
+
+    client = cli.make_grouper_client(credentials, pool_size=workers * 4)
+
+    def sync(subject_area, catalog_number, section_index=None):
+        return cli.sis2calgroups('edu:bench', term_id, subject_area,
+            catalog_number, credentials, cli.subgroups, False, client,
+            section_index=section_index)
+
+    if trace_memory:
+        tracemalloc.start()
+    failures = 0
+    try:
+        if mode == 'subject':
+            section_index = sis.get_section_index('bench', 'bench', term_id,
+                subject_area)
+            results = cli.batch.run_batch(timed(functools.partial(sync,
+                section_index=section_index)), courses, workers)
+            failures = len([e for e in results.values() if e is not None])
+        elif mode == 'single':
+            for course in courses:
+                try:
+                    timed(sync)(*course)
+                except Exception as e:
+                    failures += 1
+                    logger.error(f'{course}: {e}')
+        else:
+            results = cli.batch.run_batch(timed(sync), courses, workers)
+            failures = len([e for e in results.values() if e is not None])
+        if trace_memory:
+            peak = tracemalloc.get_traced_memory()[1]
+        else:
+            # kilobytes on linux
+            peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    finally:
+        if trace_memory:
+            tracemalloc.stop()
+        client.close()
+    return latencies, failures, peak
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmark sis2calgroups against a local mock server.")
+    parser.add_argument('--courses', type=int, default=10,
+        help='Number of synthetic courses. Default: 10')
+    parser.add_argument('--students', type=int, default=300,
+        help='Students per course. Default: 300')
+    parser.add_argument('--sections', type=int, default=5,
+        help='Sections per course, the first is primary. Default: 5')
+    parser.add_argument('--page-size', type=int, default=None,
+        help='Largest page the SIS serves, to force more pages. '
+             'Default: as requested')
+    parser.add_argument('--prefetch', type=int, default=None,
+        help='Override sis.prefetch_pages. Default: unchanged')
+    parser.add_argument('--latency', type=float, default=0.0,
+        help='Seconds of latency injected into each request. Default: 0')
+    parser.add_argument('--error-rate', type=float, default=0.0,
+        help='Fraction of requests answered with 503. Default: 0')
+    parser.add_argument('--sis-rate', type=float, default=1000,
+        help='SIS requests per second. Default: 1000')
+    parser.add_argument('--grouper-rate', type=float, default=1000,
+        help='Grouper requests per second. Default: 1000')
+    parser.add_argument('--chunk-size', type=int, default=None,
+        help='Override grouper.chunk_size. Default: unchanged')
+    parser.add_argument('--gzip', action='store_true',
+        help='Gzip Grouper request bodies.')
+    parser.add_argument('--mode', choices=['single', 'batch', 'subject'],
+        default='batch', help='Sync courses one at a time, as a batch, '
+            'or as a batch sharing one sweep of the subject\'s sections.')
+    parser.add_argument('-j', dest='workers', type=int, default=4,
+        help='Batch workers. Default: 4')
+    parser.add_argument('--runs', type=int, default=2,
+        help='Number of consecutive syncs; later ones are steady state.')
+    parser.add_argument('--trace-memory', action='store_true',
+        help='Measure peak Python allocations with tracemalloc, which '
+             'slows the run. Default: peak resident size')
+    parser.add_argument('--json', action='store_true',
+        help='Print results as JSON.')
+    args = parser.parse_args()
+
+    sis.rate_limiter = ratelimit.RateLimiter(args.sis_rate)
+    grouper.rate_limiter = ratelimit.RateLimiter(args.grouper_rate)
+    if args.prefetch:
+        sis.prefetch_pages = args.prefetch
+    if args.chunk_size:
+        grouper.chunk_size = args.chunk_size
+    grouper.compress = args.gzip
+
+    catalog = Catalog(args.courses, args.students, args.sections)
+    server = MockServer(catalog, args.latency, args.error_rate,
+        args.page_size).start()
+    point_at(server.uri)
+    credentials = {k: 'bench' for k in cli.secret_keys}
+    courses = [(subject_area, c) for c in catalog.courses]
+
+    reports = []
+    for n in range(args.runs):
+        server.reset()
+        start = time.perf_counter()
+        latencies, failures, peak = run(args.mode, server, courses,
+            credentials, args.workers, args.trace_memory)
+        elapsed = time.perf_counter() - start
+        reports.append({
+            'run': n + 1,
+            'mode': args.mode,
+            'courses': len(courses),
+            'failures': failures,
+            'seconds': round(elapsed, 3),
+            'requests_per_course': round(server.requests / len(courses), 1),
+            'bytes_sent': server.bytes_in,
+            'bytes_received': server.bytes_out,
+            'p50_seconds': round(percentile(latencies, 0.5), 4),
+            'p95_seconds': round(percentile(latencies, 0.95), 4),
+            'peak_memory_bytes': peak,
+        })
+    server.shutdown()
+
+    if args.json:
+        print(json.dumps(reports, indent=1))
+    else:
+        for report in reports:
+            print(' '.join(f'{k}={v}' for k, v in report.items()))
+
+if __name__ == '__main__':
+    main()
@@ -13,12 +13,19 @@
 # https://calnetweb.berkeley.edu/calnet-technologists/calgroups-integration/calgroups-api-information
 
 import argparse
+import concurrent.futures
+import datetime
+import hashlib
+import functools
 import json
 import logging
 import os
+import socket
 import sys
+import threading
 
-from sis2calgroups import calgroups, grouper, sis
+from sis2calgroups import batch, cache, calgroups, cassette, daemon, grouper, \
+    journal, metrics, pipeline, ratelimit, rollup, shard, sis
 
 # We use f-strings from python >= 3.6.
 assert sys.version_info >= (3, 6)
@@ -62,79 +69,361 @@ def read_credentials(filename, required_keys=secret_keys):
     return read_json_data(filename, required_keys)
 
 def course_name(subject_area, catalog_number):
-    '''Return a conventionally formatted course name, e.g. "stat-123".'''
-    return f'{subject_area}-{catalog_number}'
+    '''Return a conventionally formatted course name, e.g. "stat-123" or
+       "astron-c128".'''
+    return f'{subject_area}-{catalog_number}'.lower()
+
+def print_groups(heading, groups):
+    '''Print a dry run's (name, uids) groups under a heading. The text is
+       printed in one call so that concurrent courses do not interleave.'''
+    lines = [f'# {heading}']
+    for name, uids in groups:
+        lines.append(f'_{name}')
+        lines.extend(sorted(uids))
+    print('\n'.join(lines), flush=True)
+
+def make_grouper_client(credentials, pool_size=10):
+    '''Return a pooled Grouper client authenticated with {credentials}.'''
+    return grouper.GrouperClient(
+        credentials['grouper_user'], credentials['grouper_pass'],
+        pool_size=pool_size
+    )
+
+def subgroup_uids(subgroups, statuses=None, sections=None):
+    '''Bin the uids of a course's students and section instructors by
+       subgroup. {statuses} maps enrollment status to student uids.'''
+    uids = {}
+    # bin the student uids by enrollment status
+    student_subgroups = set(subgroup_statuses) & set(subgroups)
+    for student_subgroup in student_subgroups:
+        subgroup_status = subgroup_statuses[student_subgroup]
+        uids[student_subgroup] = statuses.get(subgroup_status, set())
+
+    # filter the uids by instructor or gsi
+    # in sis, "instructors" of primary sections are the *real* instructors.
+    # the "instructors" of the other sections are the gsis.
+    for section in sections or []:
+        # fetch the uids of this section's instructors
+        section_uids = sis.filter_section_instructors(section)
+        # classify them as instructors or gsis of any section
+        if sis.section_is_primary(section):
+            uids.setdefault('instructors', set()).update(section_uids)
+        else:
+            uids.setdefault('gsis', set()).update(section_uids)
+    return uids
+
+def primary_statuses(sections, rosters):
+    '''Return the student uids by status of a course's primary sections,
+       given the rosters of all of its sections.'''
+    statuses = {}
+    for section in sections:
+        if not sis.section_is_primary(section): continue
+        for status, uids in rosters.get(str(section['id']), {}).items():
+            statuses.setdefault(status, set()).update(uids)
+    return statuses
+
+def section_uids(sections, rosters):
+    '''Return a dict of per-section subgroup to uids, with the enrolled
+       students and the instructors of each section, e.g. lab-101-students
+       and lab-101-instructors. {rosters} maps section id to enrollment
+       status to student uids.'''
+    uids = {}
+    for section in sections:
+        name = sis.section_name(section)
+        roster = rosters.get(str(section['id']), {})
+        uids[f'{name}-students'] = set(
+            roster.get(subgroup_statuses['enrolled'], set()))
+        uids[f'{name}-instructors'] = sis.filter_section_instructors(section)
+    return uids
 
 def sis2calgroups(base_group, sis_term_id, subject_area, catalog_number,
-    credentials, subgroups, dryrun=False):
+    credentials, subgroups, dryrun=False, grouper_client=None,
+    max_churn=calgroups.max_churn, grouper_writes=4, section_index=None,
+    journal=None, uid_index=None, per_section=False):
+    '''Sync one course. Independent steps (folder creation, enrollment and
+       section fetches) run concurrently, as do the subgroup updates once
+       the uids are known, with at most {grouper_writes} Grouper writes in
+       flight. If a sis.SectionIndex of the subject area is given, the
+       course's sections are taken from it rather than fetched. If a
+       journal.Journal is given, subgroups whose uids match those last
+       pushed are not written, and the course's progress is recorded. The
+       course's uids are added to {uid_index}, a rollup.UidIndex, if given.
+       With {per_section}, each section also gets a group of its students
+       and one of its instructors. Returns the number of membership
+       changes.'''
 
     # derive a course name
     course = course_name(subject_area, catalog_number)
 
-    # determine the numeric term id (2192) from a temporal one (e.g. "current")
+    # tag the metrics of this course's requests
+    token = metrics.current_course.set(course)
+    try:
+        # determine the numeric term id (2192) from a temporal one
+        # (e.g. "current")
+        with metrics.registry.span('resolve'):
+            sis_term_id = sis.normalize_term_id(
+                credentials['sis_terms_id'], credentials['sis_terms_key'],
+                sis_term_id)
+
+        tasks = {}
+        # stream student enrollments, binning their uids by status
+        student_subgroups = set(subgroup_statuses) & set(subgroups)
+        if per_section:
+            # stream the enrollments of every section at once, binning
+            # their uids by section and status
+            def rosters(sections):
+                return sis.partition_sections(sis.iter_enrollments(
+                    credentials['sis_enrollments_id'],
+                    credentials['sis_enrollments_key'],
+                    sis_term_id, subject_area, catalog_number,
+                    lecture_codes=[str(s['id']) for s in sections]))
+            tasks['rosters'] = (metrics.registry.timed('fetch', rosters),
+                ['sections'])
+            tasks['statuses'] = (primary_statuses, ['sections', 'rosters'])
+            tasks['section_uids'] = (section_uids, ['sections', 'rosters'])
+        elif len(student_subgroups) > 0:
+            lecture_codes = None
+            if section_index is not None:
+                lecture_codes = section_index.primary_ids(catalog_number)
+
+            def statuses():
+                return sis.partition_enrollments(sis.iter_enrollments(
+                    credentials['sis_enrollments_id'],
+                    credentials['sis_enrollments_key'],
+                    sis_term_id, subject_area, catalog_number,
+                    lecture_codes=lecture_codes))
+            tasks['statuses'] = (metrics.registry.timed('fetch', statuses), [])
+
+        # fetch section data; includes primary (usually LEC) and others
+        # (i.e. LAB)
+        instructor_subgroups = set(['instructors', 'gsis']) & set(subgroups)
+        if len(instructor_subgroups) > 0 or per_section:
+            if section_index is not None:
+                tasks['sections'] = (functools.partial(section_index.sections,
+                    catalog_number), [])
+            else:
+                tasks['sections'] = (metrics.registry.timed('fetch',
+                    functools.partial(sis.get_sections,
+                        credentials['sis_classes_id'],
+                        credentials['sis_classes_key'],
+                        sis_term_id, subject_area, catalog_number)), [])
+
+        tasks['uids'] = (functools.partial(subgroup_uids, subgroups),
+            [task for task in ['statuses', 'sections'] if task in tasks])
+
+        if not dryrun:
+            if grouper_client is None:
+                grouper_client = make_grouper_client(credentials)
+            writes = threading.BoundedSemaphore(grouper_writes)
+            course_key = calgroups.course_group_id(base_group, sis_term_id,
+                course)
+
+            # structure_index keeps steady state provisioning free, so the
+            # journal only records these phases rather than skipping them;
+            # the subgroups may differ from run to run
+            def create_folders():
+                course_group = calgroups.create_folders(grouper_client,
+                    base_group, sis_term_id, course, subgroups)
+                if journal is not None:
+                    journal.record(course_key, 'provision')
+                return course_group
+
+            def sync_group(subgroup, course_group, uids):
+                members = uids.get(subgroup, [])
+                if journal is not None and journal.unchanged(course_key,
+                    subgroup, members):
+                    logger.info(f'{course_key} {subgroup} is unchanged')
+                    return 0
+                with writes, metrics.registry.span('populate'):
+                    changes = calgroups.sync_group(grouper_client,
+                        course_group, subgroup, members, max_churn)
+                if journal is not None:
+                    journal.record_push(course_key, subgroup, members)
+                return changes
+
+            def create_all_group(course_group, group_name):
+                with writes, metrics.registry.span('populate'):
+                    calgroups.create_all_group(grouper_client, course_group,
+                        group_name, subgroups)
+                if journal is not None:
+                    journal.record(course_key, 'all')
+
+            tasks['course_group'] = (metrics.registry.timed('provision',
+                create_folders), [])
+            # exclude non-enrolled ; that is not sourced from the system of
+            # record so populating here would empty it.
+            for subgroup in set(subgroups) - set(['all', 'non-enrolled']):
+                tasks[f'sync-{subgroup}'] = (functools.partial(sync_group,
+                    subgroup), ['course_group', 'uids'])
+            # our "all" group contains the other subgroups
+            tasks['group_name'] = (functools.partial(sis.all_group_name,
+                credentials['sis_terms_id'], credentials['sis_terms_key'],
+                subject_area, catalog_number, sis_term_id), [])
+            tasks['all'] = (create_all_group, ['course_group', 'group_name'])
+
+            def sync_sections(course_group, section_uids):
+                calgroups.create_groups(grouper_client, course_group,
+                    list(section_uids))
+                # sync_group bounds the writes in flight
+                with concurrent.futures.ThreadPoolExecutor(
+                    grouper_writes) as pool:
+                    futures = [metrics.submit(pool, sync_group, subgroup,
+                        course_group, section_uids)
+                        for subgroup in sorted(section_uids)]
+                    return sum(f.result() for f in futures)
+
+            if per_section:
+                tasks['sync-sections'] = (sync_sections,
+                    ['course_group', 'section_uids'])
+
+        results = pipeline.run_tasks(tasks, workers=max(3, grouper_writes))
+        if uid_index is not None:
+            uid_index.add(subject_area, catalog_number, results['uids'])
+
+        if dryrun:
+            uids = results['uids']
+            groups = [(subgroup, uids.get(subgroup, []))
+                for subgroup in subgroups]
+            groups += sorted(results.get('section_uids', {}).items())
+            print_groups(course, groups)
+            return 0
+        if journal is not None:
+            journal.record(course_key, 'done')
+        return sum(results[task] for task in results
+            if task.startswith('sync-'))
+    finally:
+        metrics.current_course.reset(token)
+
+def sync_courses(base_group, sis_term_id, courses, credentials, subgroups,
+    dryrun=False, workers=4, max_churn=calgroups.max_churn,
+    section_index=None, journal=None, rollups=False, per_section=False):
+    '''Sync many (subject_area, catalog_number) courses in one process.
+       The term is resolved once and shared by every course. Courses that
+       the journal's run has already completed are skipped. With {rollups},
+       department-wide groups are then derived from the courses' uids for
+       each subject area whose courses all synced.'''
     sis_term_id = sis.normalize_term_id(
         credentials['sis_terms_id'], credentials['sis_terms_key'],
         sis_term_id)
-
+    done = []
+    if journal is not None and not dryrun:
+        done = [course for course in courses if journal.completed(
+            calgroups.course_group_id(base_group, sis_term_id,
+                course_name(*course)))]
+        if done:
+            logger.info(f'skipping {len(done)} completed courses')
+            courses = [course for course in courses if course not in done]
+    client = None
     if not dryrun:
-        grouper_auth = grouper.auth(
-            credentials['grouper_user'], credentials['grouper_pass']
-        )
-        course_group = calgroups.create_folders(grouper_auth,
-            base_group, sis_term_id, course, subgroups)
-
-    # fetch student enrollments
-    student_subgroups = set(['enrolled', 'waitlisted', 'dropped']) & \
-                        set(subgroups)
-    if len(student_subgroups) > 0:
-        enrollments = sis.get_enrollments(
-            credentials['sis_enrollments_id'],
-            credentials['sis_enrollments_key'],
-            sis_term_id, subject_area, catalog_number
-        )
+        # share one pool of warm connections across all of the workers
+        client = make_grouper_client(credentials, pool_size=workers * 4)
+    uid_index = rollup.UidIndex() if rollups else None
+    sync = functools.partial(_sync_course, base_group, sis_term_id,
+        credentials, subgroups, dryrun, client, max_churn, section_index,
+        journal, uid_index, per_section)
+    try:
+        results = batch.run_batch(sync, courses, workers)
+        if uid_index is not None:
+            # a subject area's rollups would be missing the uids of any
+            # course that failed or that was completed in an earlier run
+            incomplete = set(sa for sa, cn in done) | set(sa for (sa, cn), e
+                in results.items() if e is not None)
+            sync_rollups(base_group, sis_term_id, uid_index, subgroups,
+                dryrun, client, max_churn, journal, incomplete)
+        return results
+    finally:
+        if client is not None:
+            client.close()
 
-    # bin the student uids by enrollment status
-    uids = {}
-    for student_subgroup in student_subgroups:
-        subgroup_status = subgroup_statuses[student_subgroup]
-        uids[student_subgroup] = sis.get_enrollment_uids(
-            sis.filter_enrollment_status(enrollments, subgroup_status))
-
-    # fetch section data; includes primary (usually LEC) and others (i.e. LAB)
-    instructor_subgroups = set(['instructors', 'gsis']) & set(subgroups)
-    if len(instructor_subgroups) > 0:
-        sections = sis.get_sections(
-            credentials['sis_classes_id'],
-            credentials['sis_classes_key'],
-            sis_term_id, subject_area, catalog_number)
-        # filter the uids by instructor or gsi
-        # in sis, "instructors" of primary sections are the *real* instructors.
-        # the "instructors" of the other sections are the gsis.
-        for section in sections:
-            # fetch the uids of this section's instructors
-            section_uids = sis.filter_section_instructors(section)
-            # classify them as instructors or gsis
-            if sis.section_is_primary(section):
-                uids['instructors'] = section_uids
-            else:
-                uids['gsis'] = section_uids
-
-    if dryrun:
-        for subgroup in subgroups:
-            print(f'_{subgroup}')
-            for uid in uids[subgroup]: print(uid)
-    else:
-        # exclude non-enrolled ; that is not sourced from the system of record
-        # so populating here would empty it.
-        for subgroup in set(subgroups) - set(['all', 'non-enrolled']):
-            calgroups.populate_group(grouper_auth, course_group, subgroup,
-                uids[subgroup])
-        # our "all" groups always contains the same members
-        group_name = sis.all_group_name(
+def _sync_course(base_group, sis_term_id, credentials, subgroups, dryrun,
+    grouper_client, max_churn, section_index, journal, uid_index,
+    per_section, subject_area, catalog_number):
+    sis2calgroups(base_group, sis_term_id, subject_area, catalog_number,
+        credentials, subgroups, dryrun, grouper_client, max_churn,
+        section_index=section_index, journal=journal, uid_index=uid_index,
+        per_section=per_section)
+
+def sync_rollups(base_group, sis_term_id, uid_index, subgroups, dryrun,
+    grouper_client, max_churn, journal=None, incomplete=()):
+    '''Push the department rollup groups of every indexed subject area
+       but those that are {incomplete}.'''
+    for subject_area in uid_index.subject_areas():
+        if subject_area in incomplete:
+            logger.warning(f'not rolling up {subject_area}; '
+                'not all of its courses were synced')
+            continue
+        rollups = uid_index.rollups(subject_area, subgroups)
+        if dryrun:
+            print_groups(f'{subject_area} rollups', rollups.items())
+            continue
+        with metrics.registry.span('rollup'):
+            rollup.create_rollup_groups(grouper_client, base_group,
+                sis_term_id, rollups, max_churn, journal)
+
+def sync_sharded(base_group, sis_term_id, courses, credentials, subgroups,
+    store, worker, run_id=None, workers=4, max_churn=calgroups.max_churn,
+    journal=None, per_section=False):
+    '''Sync this worker's share of many courses, coordinating with the
+       other workers of the run through {store}, a shard.LeaseStore. Every
+       worker must be given the same courses. The run defaults to one per
+       term, day and set of courses.'''
+    sis_term_id = sis.normalize_term_id(
+        credentials['sis_terms_id'], credentials['sis_terms_key'],
+        sis_term_id)
+    if run_id is None:
+        digest = hashlib.sha1(json.dumps(sorted(courses)).encode())
+        run_id = f'{sis_term_id}-{datetime.date.today()}-' + \
+            digest.hexdigest()[:8]
+    logger.info(f'{worker} joining run {run_id}')
+    client = make_grouper_client(credentials, pool_size=workers * 4)
+    sync = functools.partial(_sync_course, base_group, sis_term_id,
+        credentials, subgroups, False, client, max_churn, None, journal,
+        None, per_section)
+    try:
+        return shard.run(sync, courses, store, worker, run_id, workers)
+    finally:
+        client.close()
+
+def sync_subject(base_group, sis_term_id, subject_area, credentials,
+    subgroups, dryrun=False, workers=4, max_churn=calgroups.max_churn,
+    journal=None, rollups=False, per_section=False):
+    '''Sync every course in a subject area. All of the subject's sections
+       are fetched in one sweep and shared by every course.'''
+    sis_term_id = sis.normalize_term_id(
+        credentials['sis_terms_id'], credentials['sis_terms_key'],
+        sis_term_id)
+    with metrics.registry.span('fetch'):
+        section_index = sis.get_section_index(
+            credentials['sis_classes_id'], credentials['sis_classes_key'],
+            sis_term_id, subject_area)
+    courses = [(subject_area, catalog_number)
+        for catalog_number in section_index.catalog_numbers()]
+    logger.info(f'{subject_area} has {len(courses)} courses')
+    return sync_courses(base_group, sis_term_id, courses, credentials,
+        subgroups, dryrun, workers, max_churn, section_index, journal,
+        rollups, per_section)
+
+def run_daemon(base_group, sis_term_id, courses, credentials, subgroups,
+    workers=4, max_churn=calgroups.max_churn, schedule_path=None,
+    metrics_path=None, per_section=False):
+    '''Resync courses forever, each as often as its membership changes.
+       Sessions and caches stay warm between resyncs.'''
+    scheduler = daemon.Scheduler(courses, schedule_path)
+    client = make_grouper_client(credentials, pool_size=workers * 4)
+
+    def sync(subject_area, catalog_number):
+        # resolve the term on every sync so that we follow term changes
+        term_id = sis.normalize_term_id(
             credentials['sis_terms_id'], credentials['sis_terms_key'],
-            subject_area, catalog_number, sis_term_id
-        )
-        calgroups.create_all_group(grouper_auth, course_group, group_name)
+            sis_term_id)
+        return sis2calgroups(base_group, term_id, subject_area,
+            catalog_number, credentials, subgroups, False, client, max_churn,
+            per_section=per_section)
+
+    try:
+        daemon.run(sync, scheduler, workers, metrics_path)
+    finally:
+        client.close()
 
 def valid_term(string):
     valid_terms = ['Current', 'Next', 'Previous']
@@ -155,22 +444,92 @@ def main():
     parser.add_argument('-t', dest='sis_term_id', type=valid_term,
         default='Current',
         help='SIS term id or position, e.g. 2192. Default: Current')
-    parser.add_argument('-s', dest='subject_area', required=True,
+    parser.add_argument('-s', dest='subject_area',
         help='SIS subject area, e.g. ASTRON.')
-    parser.add_argument('-c', dest='catalog_number', required=True,
-        help='SIS course catalog number, 128.')
+    parser.add_argument('-c', dest='catalog_number',
+        help='SIS course catalog number, 128. Default: every course in -s')
+    parser.add_argument('-m', dest='manifest',
+        help='CSV or JSON manifest of courses to sync instead of -s/-c.')
+    parser.add_argument('-j', dest='workers', type=int, default=4,
+        help='Number of courses to sync concurrently with -m. Default: 4')
     parser.add_argument('-C', dest='credentials',
         default='/root/.sis2calgroups.json', help='Credentials file.')
+    parser.add_argument('-D', dest='daemon', action='store_true',
+        help='Run as a daemon, resyncing the -m courses as they change.')
+    parser.add_argument('-k', dest='cache_dir',
+        help='Cache SIS responses, terms, known CalGroups folders and '
+             'the -D schedule in this directory between runs.')
+    parser.add_argument('-M', dest='metrics',
+        help='Write request metrics to this file at the end of the run, '
+             'as a Prometheus textfile if it ends in .prom, else as JSON.')
     parser.add_argument('-v', dest='verbose', action='store_true',
         help='Be verbose.')
     parser.add_argument('-d', dest='debug', action='store_true',
         help='Debug.')
     parser.add_argument('-S', dest='subgroups', default=','.join(subgroups),
         type=csv_list, help='Limit operation to specific subgroups.')
+    parser.add_argument('-r', dest='max_churn', type=float,
+        default=calgroups.max_churn,
+        help='Replace all members of a group when more than this ratio '
+             'of them changed, otherwise only add and remove the changes. '
+             f'Default: {calgroups.max_churn}')
+    parser.add_argument('-l', dest='sis_rate', type=float, default=10,
+        help='Most SIS requests per second. Default: 10')
+    parser.add_argument('-L', dest='grouper_rate', type=float, default=20,
+        help='Most CalGroups requests per second. Default: 20')
+    parser.add_argument('-B', dest='chunk_size', type=int,
+        default=grouper.chunk_size,
+        help='Most members to add or remove in one CalGroups request. '
+             f'Default: {grouper.chunk_size}')
+    parser.add_argument('-z', dest='compress', action='store_true',
+        help='Gzip CalGroups request bodies, if CalGroups accepts them.')
+    parser.add_argument('-W', dest='record',
+        help='Record all SIS and CalGroups requests to this archive.')
+    parser.add_argument('-P', dest='replay',
+        help='Replay SIS and CalGroups responses from this archive '
+             'instead of using the network.')
+    parser.add_argument('-J', dest='journal',
+        help='Journal the progress of the run in this file. Subgroups '
+             'whose members are unchanged since they were last pushed are '
+             'not written.')
+    parser.add_argument('--resume', action='store_true',
+        help='Resume the last unfinished -J run, skipping the courses it '
+             'completed.')
+    parser.add_argument('-R', dest='rollups', action='store_true',
+        help='Also maintain department-wide groups of each subject area of '
+             'the -m or -s courses, e.g. astron-enrolled, in the term.')
+    parser.add_argument('-p', dest='per_section', action='store_true',
+        help='Also maintain groups of the students and of the instructors '
+             'of each section, e.g. lab-101-students.')
+    parser.add_argument('--shard', dest='lease_store',
+        help='Share the -m courses with other workers through this lease '
+             'store, syncing only this worker\'s share.')
+    parser.add_argument('--worker',
+        default=f'{socket.gethostname()}-{os.getpid()}',
+        help='Name of this --shard worker. Default: host-pid')
+    parser.add_argument('--run', dest='run_id',
+        help='Name of the --shard run that the workers share. '
+             'Default: the term, date and a hash of the courses')
     parser.add_argument('-n', dest='dryrun', action='store_true',
         help='Dry run. Print enrollments without updating CalGroups.')
     args = parser.parse_args()
-    
+    if not args.manifest and not args.subject_area:
+        parser.error('either -m or -s is required')
+    if args.record and args.replay:
+        parser.error('-W and -P cannot be used together')
+    if args.daemon and (not args.manifest or args.dryrun):
+        parser.error('-D requires -m and cannot be a dry run')
+    if args.resume and not args.journal:
+        parser.error('--resume requires -J')
+    if args.journal and (args.daemon or args.dryrun):
+        parser.error('-J cannot be used with -D or -n')
+    if args.lease_store and (not args.manifest or args.daemon or
+        args.dryrun or args.rollups):
+        parser.error('--shard requires -m and cannot be used with -D, -n or -R')
+    if args.rollups and (args.daemon or
+        (not args.manifest and args.catalog_number)):
+        parser.error('-R requires -m or -s without -c, and not -D')
+
     if args.verbose:
         logger.setLevel(logging.INFO)
     elif args.debug:
@@ -178,6 +537,87 @@ def main():
     
     # read credentials from credentials file
     credentials = read_credentials(args.credentials)
-    
-    sis2calgroups(args.base_group, args.sis_term_id, args.subject_area.lower(),
-        args.catalog_number, credentials, args.subgroups, args.dryrun)
+
+    sis.rate_limiter = ratelimit.RateLimiter(args.sis_rate)
+    grouper.rate_limiter = ratelimit.RateLimiter(args.grouper_rate)
+    grouper.chunk_size = args.chunk_size
+    grouper.compress = args.compress
+
+    tape = None
+    if args.record:
+        tape = cassette.Cassette(args.record, 'record')
+    elif args.replay:
+        tape = cassette.Cassette(args.replay, 'replay')
+        # replay at local speed
+        sis.rate_limiter = ratelimit.RateLimiter(10 ** 6)
+        grouper.rate_limiter = ratelimit.RateLimiter(10 ** 6)
+    if tape is not None:
+        cassette.use(tape)
+        tape.mount(sis.session)
+
+    if args.cache_dir:
+        sis.response_cache = cache.ResponseCache(args.cache_dir)
+        sis.term_index = sis.TermIndex(
+            credentials['sis_terms_id'], credentials['sis_terms_key'],
+            os.path.join(args.cache_dir, 'terms.json'))
+        calgroups.structure_index = calgroups.StructureIndex(
+            os.path.join(args.cache_dir, 'structure.json'))
+
+    run_journal = None
+    if args.journal:
+        run_journal = journal.Journal(args.journal)
+        run_journal.start_run(args.resume)
+
+    failed = False
+    try:
+        if args.daemon:
+            schedule_path = None
+            if args.cache_dir:
+                schedule_path = os.path.join(args.cache_dir, 'schedule.json')
+            run_daemon(args.base_group, args.sis_term_id,
+                batch.read_manifest(args.manifest), credentials,
+                args.subgroups, args.workers, args.max_churn, schedule_path,
+                args.metrics, args.per_section)
+        elif args.lease_store:
+            store = shard.LeaseStore(args.lease_store)
+            try:
+                results = sync_sharded(args.base_group, args.sis_term_id,
+                    batch.read_manifest(args.manifest), credentials,
+                    args.subgroups, store, args.worker, args.run_id,
+                    args.workers, args.max_churn, run_journal,
+                    args.per_section)
+            finally:
+                store.close()
+            failed = any(results.values())
+        elif args.manifest:
+            courses = batch.read_manifest(args.manifest)
+            results = sync_courses(args.base_group, args.sis_term_id, courses,
+                credentials, args.subgroups, args.dryrun, args.workers,
+                args.max_churn, journal=run_journal, rollups=args.rollups,
+                per_section=args.per_section)
+            failed = any(results.values())
+        elif not args.catalog_number:
+            results = sync_subject(args.base_group, args.sis_term_id,
+                args.subject_area.lower(), credentials, args.subgroups,
+                args.dryrun, args.workers, args.max_churn, run_journal,
+                args.rollups, args.per_section)
+            failed = any(results.values())
+        else:
+            sis2calgroups(args.base_group, args.sis_term_id,
+                args.subject_area.lower(), args.catalog_number.upper(),
+                credentials, args.subgroups, args.dryrun, max_churn=args.max_churn,
+                journal=run_journal, per_section=args.per_section)
+        if run_journal is not None and not failed:
+            run_journal.finish_run()
+    finally:
+        if run_journal is not None:
+            run_journal.close()
+        if tape is not None:
+            tape.save()
+        if args.metrics:
+            metrics.registry.write(args.metrics)
+        if sis.response_cache is not None:
+            logger.info(f'SIS response cache: {sis.response_cache.stats()}')
+            sis.response_cache.close()
+    if failed:
+        sys.exit(1)
@@ -0,0 +1,64 @@
+# vim:set et sw=4 ts=4:
+import concurrent.futures
+import csv
+import json
+import logging
+import os
+import sys
+
+# logging
+logging.basicConfig(stream=sys.stdout, level=logging.WARNING)
+logger = logging.getLogger(__name__)
+
+manifest_keys = ['subject_area', 'catalog_number']
+
+def read_manifest(filename):
+    '''Read a course manifest from a CSV or JSON file. Returns a list of
+       (subject_area, catalog_number) tuples, with subject areas in lower
+       case and catalog numbers in upper case as the SIS formats them.
+
+       A CSV manifest has a header row naming the subject_area and
+       catalog_number columns. A JSON manifest is a list of objects with
+       those keys, or a list of [subject_area, catalog_number] pairs.'''
+    if not os.path.exists(filename):
+        raise Exception(f"No such file: {filename}")
+    with open(filename) as f:
+        if filename.endswith('.json'):
+            rows = json.load(f)
+        else:
+            rows = list(csv.DictReader(f))
+    courses = []
+    for row in rows:
+        if isinstance(row, dict):
+            missing = set(manifest_keys) - set(row.keys())
+            if missing:
+                raise Exception(f"Missing parameters in {filename}: {missing}")
+            row = [row[k] for k in manifest_keys]
+        subject_area, catalog_number = [str(x).strip() for x in row]
+        courses.append((subject_area.lower(), catalog_number.upper()))
+    return courses
+
+def run_batch(sync, courses, workers=4):
+    '''Run sync(subject_area, catalog_number) for every course on a bounded
+       thread pool. A failing course does not abort the others. Returns a
+       dict of (subject_area, catalog_number) -> exception, or None for
+       courses that succeeded.'''
+    results = {}
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = {
+            pool.submit(sync, subject_area, catalog_number):
+                (subject_area, catalog_number)
+            for subject_area, catalog_number in courses
+        }
+        for future in concurrent.futures.as_completed(futures):
+            course = futures[future]
+            try:
+                future.result()
+                results[course] = None
+                logger.info(f'{course[0]} {course[1]}: ok')
+            except Exception as e:
+                results[course] = e
+                logger.error(f'{course[0]} {course[1]}: {e}')
+    failed = len([e for e in results.values() if e is not None])
+    logger.info(f'{len(results) - failed} courses succeeded, {failed} failed')
+    return results
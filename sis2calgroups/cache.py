@@ -0,0 +1,127 @@
+# vim:set et sw=4 ts=4:
+import collections
+import logging
+import os
+import sqlite3
+import sys
+import threading
+import time
+import urllib.parse
+
+# logging
+logging.basicConfig(stream=sys.stdout, level=logging.WARNING)
+logger = logging.getLogger(__name__)
+
+# Seconds that a response from each SIS endpoint is used without asking the
+# SIS again. Endpoints are matched against the request uri in order.
+default_ttls = collections.OrderedDict([
+    ('descriptors', 24 * 3600),
+    ('enrollments', 15 * 60),
+    ('classes', 6 * 3600),
+    ('terms', 24 * 3600),
+])
+
+default_max_bytes = 256 * 1024 * 1024
+
+Entry = collections.namedtuple('Entry',
+    ['body', 'etag', 'last_modified', 'fresh'])
+
+def cache_key(uri, params):
+    '''Return a key for a request to {uri} with query {params}. Params are
+       sorted so that equivalent requests share an entry.'''
+    query = sorted((str(k), str(v).strip()) for k, v in (params or {}).items())
+    return uri + '?' + urllib.parse.urlencode(query)
+
+class ResponseCache:
+    '''A persistent cache of SIS responses in a SQLite database within
+       {directory}. Entries expire after a per-endpoint ttl, after which they
+       may be revalidated with the ETag or Last-Modified of the response. The
+       least recently used entries are evicted once the cache exceeds
+       {max_bytes}.'''
+
+    def __init__(self, directory, ttls=None, max_bytes=default_max_bytes):
+        os.makedirs(directory, exist_ok=True)
+        self.path = os.path.join(directory, 'responses.sqlite')
+        self.ttls = default_ttls if ttls is None else ttls
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.revalidated = 0
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(self.path, check_same_thread=False)
+        self._db.execute('''create table if not exists responses (
+            key text primary key, body text, etag text, last_modified text,
+            fetched real, accessed real, size integer)''')
+        self._db.commit()
+
+    def ttl(self, uri):
+        for endpoint, ttl in self.ttls.items():
+            if endpoint in uri:
+                return ttl
+        return 0
+
+    def get(self, uri, params):
+        '''Return the cached Entry for a request, or None.'''
+        key = cache_key(uri, params)
+        now = time.time()
+        with self._lock:
+            row = self._db.execute('''select body, etag, last_modified,
+                fetched from responses where key = ?''', (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            body, etag, last_modified, fetched = row
+            fresh = now - fetched < self.ttl(uri)
+            if fresh:
+                self.hits += 1
+            else:
+                self.misses += 1
+            self._db.execute('update responses set accessed = ? where key = ?',
+                (now, key))
+            self._db.commit()
+        return Entry(body, etag, last_modified, fresh)
+
+    def put(self, uri, params, body, etag=None, last_modified=None):
+        '''Store the response {body} of a request.'''
+        key = cache_key(uri, params)
+        now = time.time()
+        with self._lock:
+            self._db.execute('''insert or replace into responses
+                (key, body, etag, last_modified, fetched, accessed, size)
+                values (?, ?, ?, ?, ?, ?, ?)''',
+                (key, body, etag, last_modified, now, now, len(body)))
+            self._evict()
+            self._db.commit()
+
+    def touch(self, uri, params):
+        '''Mark a stale entry as fresh after the SIS confirmed that it has
+           not changed.'''
+        key = cache_key(uri, params)
+        now = time.time()
+        with self._lock:
+            self.revalidated += 1
+            self._db.execute('''update responses set fetched = ?,
+                accessed = ? where key = ?''', (now, now, key))
+            self._db.commit()
+
+    def _evict(self):
+        total = self._db.execute(
+            'select coalesce(sum(size), 0) from responses').fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        rows = self._db.execute(
+            'select key, size from responses order by accessed').fetchall()
+        for key, size in rows:
+            if total <= self.max_bytes:
+                break
+            self._db.execute('delete from responses where key = ?', (key,))
+            total -= size
+            logger.debug(f'evicted {key}')
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses,
+            'revalidated': self.revalidated}
+
+    def close(self):
+        with self._lock:
+            self._db.close()
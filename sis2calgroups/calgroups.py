@@ -1,51 +1,141 @@
+import json
 import logging
+import os
 import sys
-
-from sis2calgroups import grouper
+import threading
 
 logging.basicConfig(stream=sys.stdout, level=logging.WARNING)
 logger = logging.getLogger('calgroups')
 
+# above this ratio of changed to current members, replace a group's members
+# rather than sending individual adds and removes
+max_churn = 0.5
+
 def child_id(calgroup, child):
     '''Given a:base:group for a course, return a:base:group:group-child.'''
     els = calgroup.split(':')
     return ':'.join(els + [els[-1] + '-' + str(child)])
     
-def create_folders(grouper_auth, base_group, term_id, course_name, subgroups):
-    '''
-    '''
+class StructureIndex:
+    '''The set of stems and groups known to exist in Grouper, so that they
+       need not be saved again. If {path} is given the index is persisted
+       there between runs; remove the file if groups are deleted in Grouper.'''
+
+    def __init__(self, path=None):
+        self.path = path
+        self.names = set()
+        self._lock = threading.Lock()
+        if path and os.path.exists(path):
+            with open(path) as f:
+                self.names = set(json.load(f))
+
+    def missing(self, names):
+        with self._lock:
+            return [name for name in names if name not in self.names]
+
+    def add(self, names):
+        with self._lock:
+            self.names.update(names)
+            if self.path:
+                tmp = self.path + '.tmp'
+                with open(tmp, 'w') as f:
+                    json.dump(sorted(self.names), f)
+                os.replace(tmp, self.path)
+
+# stems and groups known to exist, shared by every course in a run
+structure_index = StructureIndex()
+
+# held while the term stem is checked and saved so that concurrent courses
+# do not race to create it
+_term_lock = threading.Lock()
+
+def course_group_id(base_group, term_id, course_name):
+    '''Return the course group of a course in a term.'''
     # term ~ {base_group}:stat-classes-2188
     term_group = child_id(base_group, term_id)
-    # course_group ~ {term_group}:stat-classes-2188-stat-243'''
-    course_group = child_id(term_group, course_name)
+    # course_group ~ {term_group}:stat-classes-2188-stat-243
+    return child_id(term_group, course_name)
+
+def create_folders(grouper_client, base_group, term_id, course_name, subgroups):
+    '''Create the term and course stems and the course's subgroups, saving
+       only those that are not already in structure_index. Returns the
+       course group.'''
+    term_group = child_id(base_group, term_id)
+    course_group = course_group_id(base_group, term_id, course_name)
     logger.info(course_group)
 
-    # create the folder for the term
-    out = grouper.create_stem(grouper_auth, term_group, term_id)
-    logger.info(f"creating stem {term_id}")
+    # create the folder for the term on its own, once, so that the requests
+    # made do not depend on which of several concurrent courses gets there
+    # first
+    with _term_lock:
+        if structure_index.missing([term_group]):
+            logger.info(f"creating stem {term_group}")
+            grouper_client.save_stems([(term_group, term_id)])
+            structure_index.add([term_group])
     # create the folder for the course
-    out = grouper.create_stem(grouper_auth, course_group, course_name)
-    logger.info(f"creating stem {course_name}")
+    if structure_index.missing([course_group]):
+        logger.info(f"creating stem {course_group}")
+        grouper_client.save_stems([(course_group, course_name)])
+        structure_index.add([course_group])
     # create the groups for the course
-    for subgroup in subgroups:
-        group = child_id(course_group, subgroup)
-        logger.info(f"creating group {group}")
-        out = grouper.create_group(grouper_auth, group, subgroup)
+    create_groups(grouper_client, course_group, subgroups)
     return course_group
 
-def populate_group(grouper_auth, course_group, subgroup, uids):
-	num = len(uids)
+def create_groups(grouper_client, course_group, subgroups):
+    '''Create the subgroups of a course that are not already in
+       structure_index in one request.'''
+    groups = {child_id(course_group, subgroup): subgroup
+        for subgroup in subgroups}
+    missing = structure_index.missing(groups)
+    if missing:
+        logger.info(f"creating groups {missing}")
+        grouper_client.save_groups([(group, groups[group])
+            for group in missing])
+        structure_index.add(missing)
+
+def sync_group(grouper_client, course_group, subgroup, uids,
+	max_churn=max_churn):
+	'''Bring the members of a subgroup in line with {uids} by adding and
+	   removing only those members that changed. Falls back to a full replace
+	   when the changes exceed {max_churn} of the current membership.
+	   Returns the number of members added or removed.'''
 	group = child_id(course_group, subgroup)
-	logger.info(f"setting {num} users in {group}")
-	grouper.replace_users(grouper_auth, group, uids)
+	uids = set(uids)
+	current = grouper_client.get_members(group)
+	adds = uids - current
+	removes = current - uids
+	changes = len(adds) + len(removes)
+	if changes == 0:
+		logger.info(f"no changes in {group}")
+	elif len(current) == 0 or changes / len(current) > max_churn:
+		logger.info(f"setting {len(uids)} users in {group}")
+		grouper_client.replace_users(group, uids)
+	else:
+		logger.info(f"adding {len(adds)}, removing {len(removes)} in {group}")
+		if adds:
+			grouper_client.add_members(group, adds)
+		if removes:
+			grouper_client.delete_members(group, removes)
+	return changes
 
-def create_all_group(grouper_auth, course_group, group_name):
+def create_all_group(grouper_client, course_group, group_name, subgroups):
 	'''Create an "all" group that contains all students, instructors,
 	   admins, etc. We specify a friendly name for the name since Google Groups
-       and perhaps AD will use it.'''
+	   and perhaps AD will use it. The other subgroups are members of "all",
+	   so Grouper keeps it up to date and it need not be repopulated.'''
 	group_id = child_id(course_group, 'all')
-	grouper.create_group(grouper_auth, group_id, group_name):
+	if structure_index.missing([group_id]):
+		grouper_client.save_groups([(group_id, group_name)])
+		structure_index.add([group_id])
 
 	# put other subgroups into this one
-	uids = get_subgroup_uids(grouper_auth, course_group)
-	grouper.replace_users(grouper_auth, group, uids)
+	members = [child_id(course_group, subgroup) for subgroup in subgroups
+		if subgroup not in ['all', 'dropped']]
+	# record each nesting in the index as "{group} > {member}"
+	nestings = {f'{group_id} > {member}': member for member in members}
+	missing = structure_index.missing(nestings)
+	if missing:
+		logger.info(f"nesting {len(missing)} groups in {group_id}")
+		grouper_client.add_groups(group_id,
+			[nestings[nesting] for nesting in missing])
+		structure_index.add(missing)
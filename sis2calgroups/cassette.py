@@ -0,0 +1,140 @@
+# vim:set et sw=4 ts=4:
+import collections
+import gzip
+import json
+import logging
+import sys
+import threading
+import urllib.parse
+
+import requests
+from requests.adapters import BaseAdapter
+from requests.structures import CaseInsensitiveDict
+
+# logging
+logging.basicConfig(stream=sys.stdout, level=logging.WARNING)
+logger = logging.getLogger(__name__)
+
+# the cassette that new sessions should use, if any
+active = None
+
+# response headers worth keeping in a recording
+kept_headers = ['Content-Type', 'ETag', 'Last-Modified', 'Retry-After']
+
+def _canonical(value):
+    '''Sort lists and keys so that requests built from sets match.'''
+    if isinstance(value, dict):
+        return {k: _canonical(v) for k, v in value.items()}
+    if isinstance(value, list):
+        items = [_canonical(v) for v in value]
+        return sorted(items, key=lambda v: json.dumps(v, sort_keys=True))
+    return value
+
+def request_key(request):
+    '''Return a key for a requests.PreparedRequest from its method, path,
+       sorted query params and canonical JSON body, uncompressed.
+       Credentials, which are sent in headers, are not part of the key.'''
+    url = urllib.parse.urlsplit(request.url)
+    query = urllib.parse.urlencode(
+        sorted(urllib.parse.parse_qsl(url.query)))
+    body = request.body or ''
+    if request.headers.get('Content-Encoding') == 'gzip':
+        body = gzip.decompress(body)
+    if isinstance(body, bytes):
+        body = body.decode('utf-8', 'replace')
+    try:
+        body = json.dumps(_canonical(json.loads(body)), sort_keys=True)
+    except ValueError:
+        pass
+    return f'{request.method} {url.path}?{query} {body}'
+
+class Cassette:
+    '''An archive of HTTP request/response pairs. In record mode responses
+       are fetched as usual and saved; in replay mode they are served from
+       the archive without touching the network. Identical requests are
+       replayed in the order that they were recorded.'''
+
+    def __init__(self, path, mode):
+        if mode not in ['record', 'replay']:
+            raise Exception(f'Unknown cassette mode: {mode}')
+        self.path = path
+        self.mode = mode
+        self.interactions = collections.defaultdict(list)
+        self._replayed = collections.Counter()
+        self._lock = threading.Lock()
+        if mode == 'replay':
+            with gzip.open(path, 'rt') as f:
+                for line in f:
+                    interaction = json.loads(line)
+                    self.interactions[interaction['key']].append(interaction)
+
+    def mount(self, session):
+        '''Route a requests.Session's traffic through this cassette.'''
+        for prefix in ['https://', 'http://']:
+            adapter = session.get_adapter(prefix + 'example')
+            session.mount(prefix, CassetteAdapter(self, adapter))
+
+    def record(self, key, response):
+        interaction = {
+            'key': key,
+            'status': response.status_code,
+            'reason': response.reason,
+            'headers': {h: response.headers[h] for h in kept_headers
+                if h in response.headers},
+            'body': response.content.decode('utf-8', 'replace'),
+        }
+        with self._lock:
+            self.interactions[key].append(interaction)
+
+    def replay(self, request):
+        key = request_key(request)
+        with self._lock:
+            recorded = self.interactions.get(key)
+            if not recorded:
+                raise Exception(f'No recorded response for {key}')
+            # repeat the last response once the recorded ones are used up
+            n = min(self._replayed[key], len(recorded) - 1)
+            self._replayed[key] += 1
+        interaction = recorded[n]
+        response = requests.Response()
+        response.status_code = interaction['status']
+        response.reason = interaction['reason']
+        response.headers = CaseInsensitiveDict(interaction['headers'])
+        response._content = interaction['body'].encode('utf-8')
+        response.encoding = 'utf-8'
+        response.url = request.url
+        response.request = request
+        return response
+
+    def save(self):
+        '''Write the recorded interactions to the archive.'''
+        if self.mode != 'record':
+            return
+        with self._lock, gzip.open(self.path, 'wt') as f:
+            for interactions in self.interactions.values():
+                for interaction in interactions:
+                    f.write(json.dumps(interaction) + '\n')
+        logger.info(f'recorded {len(self.interactions)} requests to {self.path}')
+
+class CassetteAdapter(BaseAdapter):
+    '''A transport adapter that records or replays through a Cassette.'''
+
+    def __init__(self, cassette, adapter):
+        super().__init__()
+        self.cassette = cassette
+        self.adapter = adapter
+
+    def send(self, request, **kwargs):
+        if self.cassette.mode == 'replay':
+            return self.cassette.replay(request)
+        response = self.adapter.send(request, **kwargs)
+        self.cassette.record(request_key(request), response)
+        return response
+
+    def close(self):
+        self.adapter.close()
+
+def use(cassette):
+    '''Make {cassette} the active cassette for SIS and Grouper sessions.'''
+    global active
+    active = cassette
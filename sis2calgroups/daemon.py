@@ -0,0 +1,131 @@
+# vim:set et sw=4 ts=4:
+import json
+import logging
+import os
+import sys
+import threading
+import time
+
+from sis2calgroups import batch, metrics
+
+# logging
+logging.basicConfig(stream=sys.stdout, level=logging.WARNING)
+logger = logging.getLogger(__name__)
+
+# bounds on the seconds between resyncs of a course
+min_interval = 15 * 60
+max_interval = 24 * 3600
+
+# longest time to sleep before checking the schedule again
+poll_interval = 60
+
+def course_key(subject_area, catalog_number):
+    return f'{subject_area}:{catalog_number}'
+
+class Scheduler:
+    '''Schedules each course's next resync from its observed change rate.
+       A course whose last sync changed membership is resynced sooner, and
+       one whose last sync changed nothing is resynced later, within
+       {min_interval} and {max_interval} seconds. If {path} is given the
+       schedule is persisted there so that it survives restarts.'''
+
+    def __init__(self, courses, path=None, min_interval=min_interval,
+        max_interval=max_interval):
+        self.path = path
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.courses = {course_key(*c): c for c in courses}
+        self.schedule = {}
+        self._lock = threading.Lock()
+        if path and os.path.exists(path):
+            with open(path) as f:
+                self.schedule = json.load(f).get('courses', {})
+        now = time.time()
+        for key in self.courses:
+            # new courses are due immediately
+            self.schedule.setdefault(key,
+                {'next': now, 'interval': self.min_interval})
+        # forget courses that are no longer in the manifest
+        for key in set(self.schedule) - set(self.courses):
+            del self.schedule[key]
+
+    def due(self, now=None):
+        '''Return the courses that are due for a resync.'''
+        now = time.time() if now is None else now
+        with self._lock:
+            return [self.courses[key] for key, entry in self.schedule.items()
+                if entry['next'] <= now]
+
+    def queue_depth(self, now=None):
+        '''Return the number of courses that are due for a resync.'''
+        return len(self.due(now))
+
+    def next_due(self):
+        '''Return the time at which the next course is due.'''
+        with self._lock:
+            return min((entry['next'] for entry in self.schedule.values()),
+                default=time.time() + poll_interval)
+
+    def record(self, subject_area, catalog_number, changes):
+        '''Reschedule a course after a sync that made {changes} membership
+           changes.'''
+        key = course_key(subject_area, catalog_number)
+        with self._lock:
+            entry = self.schedule[key]
+            if changes:
+                interval = max(self.min_interval, entry['interval'] / 2)
+            else:
+                interval = min(self.max_interval, entry['interval'] * 2)
+            entry['interval'] = interval
+            entry['next'] = time.time() + interval
+            entry['changes'] = changes
+        logger.info(f'{key}: {changes} changes, next in {interval:.0f}s')
+
+    def failed(self, subject_area, catalog_number):
+        '''Retry a course that failed to sync after the minimum interval.'''
+        key = course_key(subject_area, catalog_number)
+        with self._lock:
+            self.schedule[key]['next'] = time.time() + self.min_interval
+
+    def save(self):
+        if not self.path:
+            return
+        with self._lock:
+            data = {
+                'courses': self.schedule,
+                'queue_depth': len([e for e in self.schedule.values()
+                    if e['next'] <= time.time()]),
+                'updated': time.time()
+            }
+            tmp = self.path + '.tmp'
+            with open(tmp, 'w') as f:
+                json.dump(data, f, indent=1)
+            os.replace(tmp, self.path)
+
+def run(sync, scheduler, workers=4, metrics_path=None):
+    '''Resync courses forever as they come due. sync(subject_area,
+       catalog_number) must return the number of membership changes.
+       If {metrics_path} is given, metrics are written there after every
+       round of resyncs.'''
+    def resync(subject_area, catalog_number):
+        try:
+            changes = sync(subject_area, catalog_number)
+        except Exception:
+            scheduler.failed(subject_area, catalog_number)
+            raise
+        scheduler.record(subject_area, catalog_number, changes)
+
+    while True:
+        due = scheduler.due()
+        logger.info(f'queue depth {len(due)}')
+        metrics.registry.set_gauge('queue_depth', len(due))
+        scheduler.save()
+        if due:
+            batch.run_batch(resync, due, workers)
+        scheduler.save()
+        metrics.registry.set_gauge('queue_depth', scheduler.queue_depth())
+        if metrics_path:
+            metrics.registry.write(metrics_path)
+        delay = min(poll_interval, scheduler.next_due() - time.time())
+        if delay > 0:
+            time.sleep(delay)
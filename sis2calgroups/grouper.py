@@ -1,91 +1,275 @@
 # vim:set et ts=4 sw=4:
 
+import itertools
 import json
 import logging
+import time
+import zlib
 
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from sis2calgroups import cassette, metrics, ratelimit
 
 # logging
 logger = logging.getLogger('grouper')
-logger.setLevel(logging.DEBUG)
 
 base_uri = 'https://calgroups.berkeley.edu/gws/servicesRest/json/v2_2_100'
 
+# requests per second to Grouper, shared by all clients and threads
+rate_limiter = ratelimit.RateLimiter(20)
+
 def auth(user, password):
     return requests.auth.HTTPBasicAuth(user, password)
 
-def create_stem(auth, stem, name):
-    '''Create a new grouper stem.'''
-    # https://github.com/Internet2/grouper/blob/master/grouper-ws/grouper-ws/doc/samples/stemSave/WsSampleStemSaveRestLite_json.txt
-    logger.info('creating {}'.format(stem))
-    data = {
-        "WsRestStemSaveLiteRequest": {
-            "description":name,
-            "displayExtension":name,
-            "stemName":stem
+# most members to add or delete in one request
+chunk_size = 1000
+
+# gzip request bodies; grouper must be configured to accept them
+compress = False
+
+# the subject source of grouper groups, when they are members of other groups
+group_source = 'g:gsa'
+
+# lookups are sorted so that a set of members is always cut into the same
+# chunks, whatever the hash seed, and recorded requests can be replayed
+
+def user_lookups(users):
+    return ({"subjectId":user} for user in sorted(users))
+
+def group_lookups(groups):
+    return ({"subjectIdentifier":group, "subjectSourceId":group_source}
+        for group in sorted(groups))
+
+def chunks(items, size):
+    '''Yield lists of up to {size} of {items}; at least one, even if it is
+       empty.'''
+    items = iter(items)
+    chunk = list(itertools.islice(items, size))
+    while True:
+        yield chunk
+        chunk = list(itertools.islice(items, size))
+        if not chunk:
+            return
+
+def encode(data, gzip=False):
+    '''Encode {data} as a JSON request body, gzipped with {gzip}. Large
+       membership changes are encoded a chunk at a time, so a body is at
+       most chunk_size lookups.'''
+    body = json.dumps(data).encode()
+    if not gzip:
+        return body
+    # wbits=31 writes a gzip container, with no timestamp so that
+    # identical requests have identical bodies
+    compressor = zlib.compressobj(wbits=31)
+    return compressor.compress(body) + compressor.flush()
+
+def endpoint_name(path):
+    '''Return the name of the Grouper endpoint of {path}, e.g. "members".'''
+    if path.endswith('/members'):
+        return 'members'
+    return path.split('/')[0]
+
+class GrouperClient:
+    '''A Grouper web services client. Calls share a pooled, keep-alive
+       requests.Session so that many operations reuse warm connections.'''
+
+    def __init__(self, user, password, pool_size=10, timeout=60, retries=3,
+        backoff=0.5, rate_limiter=None, chunk_size=None, compress=None):
+        self.timeout = timeout
+        # by default, the module's chunk_size and compress
+        self.chunk_size = chunk_size
+        self.compress = compress
+        # throttling (429, 503) is retried by the rate limiter, by default
+        # the module's shared one
+        self.rate_limiter = rate_limiter
+        self.session = requests.Session()
+        self.session.auth = auth(user, password)
+        self.session.headers.update({'Content-type':'text/x-json'})
+        retry = Retry(total=retries, backoff_factor=backoff,
+            status_forcelist=[500, 502, 504],
+            allowed_methods=['GET', 'POST', 'PUT'], raise_on_status=False)
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size,
+            max_retries=retry)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        if cassette.active is not None:
+            cassette.active.mount(self.session)
+
+    def close(self):
+        self.session.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _request(self, method, path, data):
+        gzip = compress if self.compress is None else self.compress
+        body = encode(data, gzip)
+        headers = {'Content-Encoding': 'gzip'} if gzip else {}
+
+        def send(attempt):
+            start = time.perf_counter()
+            r = self.session.request(method, f'{base_uri}/{path}',
+                data=body, headers=headers, timeout=self.timeout)
+            retry = getattr(r.raw, 'retries', None)
+            retries = len(retry.history) if retry else 0
+            # count throttled retries by the rate limiter too
+            if attempt:
+                retries += 1
+            metrics.registry.record('grouper', endpoint_name(path),
+                r.status_code, time.perf_counter() - start, len(body),
+                len(r.content), retries)
+            return r
+
+        limiter = self.rate_limiter or rate_limiter
+        r = limiter.call(send)
+        if gzip and r.status_code == 415:
+            logger.warning('grouper does not accept gzipped requests')
+            self.compress = False
+            return self._request(method, path, data)
+        if r.status_code in ratelimit.throttle_statuses:
+            raise Exception(f'{r.status_code} {r.reason} from {path}')
+        try:
+            return r.json()
+        except ValueError:
+            # e.g. a proxy's error page once urllib3 has given up retrying
+            if r.status_code >= 500:
+                raise Exception(f'{r.status_code} {r.reason} from {path}')
+            raise
+
+    def save_stems(self, stems):
+        '''Create or update many grouper stems in one request. {stems} is a
+           list of (stem, name) tuples.'''
+        # https://github.com/Internet2/grouper/blob/master/grouper-ws/grouper-ws/doc/samples/stemSave/WsSampleStemSaveRest_json.txt
+        logger.info('saving {} stems'.format(len(stems)))
+        data = {
+            "WsRestStemSaveRequest": {
+                "wsStemToSaves":[
+                    {
+                        "wsStem":{
+                            "description":name,
+                            "displayExtension":name,
+                            "name":stem
+                        },
+                        "wsStemLookup":{"stemName":stem}
+                    } for stem, name in stems
+                ]
+            }
         }
-    }
-    r = requests.post(f'{base_uri}/stems/{stem}',
-        data=json.dumps(data), auth=auth, headers={'Content-type':'text/x-json'}
-    )
-    out = r.json()
-    if 'WsRestResultProblem' in out:
-        msg = out['WsRestResultProblem']['resultMetadata']['resultMessage']
-        raise Exception(msg)
-    if 'WsStemSaveLiteResult' in out:
-        code = out['WsStemSaveLiteResult']['resultMetadata']['resultCode']
-        if code not in ['SUCCESS_INSERTED', 'SUCCESS_NO_CHANGES_NEEDED']:
-            msg = out['WsStemSaveLiteResult']['resultMetadata']['resultMessage']
-            raise Exception(f'{code}: {msg}')
-    return out
-
-def create_group(auth, group, name):
-    '''Create a new grouper group.'''
-    # https://github.com/Internet2/grouper/blob/master/grouper-ws/grouper-ws/doc/samples/groupSave/WsSampleGroupSaveRestLite_json.txt
-    logger.info('creating {}'.format(group))
-    data = {
-        "WsRestGroupSaveLiteRequest": {
-            "description":name,
-            "displayExtension":name,
-            "groupName":group
+        out = self._request('POST', 'stems', data)
+        self._check_save_results(out, 'WsStemSaveResults', stems)
+        return out
+
+    def save_groups(self, groups):
+        '''Create or update many grouper groups in one request. {groups} is a
+           list of (group, name) tuples.'''
+        # https://github.com/Internet2/grouper/blob/master/grouper-ws/grouper-ws/doc/samples/groupSave/WsSampleGroupSaveRest_json.txt
+        logger.info('saving {} groups'.format(len(groups)))
+        data = {
+            "WsRestGroupSaveRequest": {
+                "wsGroupToSaves":[
+                    {
+                        "wsGroup":{
+                            "description":name,
+                            "displayExtension":name,
+                            "name":group
+                        },
+                        "wsGroupLookup":{"groupName":group}
+                    } for group, name in groups
+                ]
+            }
         }
-    }
-    r = requests.post(f'{base_uri}/groups/{group}',
-        data=json.dumps(data), auth=auth, headers={'Content-type':'text/x-json'}
-    )
-    out = r.json()
-    if 'WsRestResultProblem' in out:
-        msg = out['WsRestResultProblem']['resultMetadata']['resultMessage']
-        meta = out['WsRestResultProblem']['resultMetadata']
-        print(f'Error creating group: {group} {data}')
-        raise Exception(meta)
-    if 'WsGroupSaveLiteResult' in out:
-        code = out['WsGroupSaveLiteResult']['resultMetadata']['resultCode']
-        if code not in ['SUCCESS_INSERTED', 'SUCCESS_NO_CHANGES_NEEDED']:
-            msg = out['WsGroupSaveLiteResult']['resultMetadata']['resultMessage']
-            print(f'Error creating group: {group} {data}')
-            raise Exception(f'{code}: {msg}')
-    return out
-
-def replace_users(auth, group, users):
-    '''Replace the members of the grouper group {group} with {users}.'''
-    logger.info('transferring to {}'.format(group))
-    # https://github.com/Internet2/grouper/blob/master/grouper-ws/grouper-ws/doc/samples/addMember/WsSampleAddMemberRest_json.txt
-    data = {
-        "WsRestAddMemberRequest": {
-            "replaceAllExisting":"T",
-            "subjectLookups":[]
+        out = self._request('POST', 'groups', data)
+        self._check_save_results(out, 'WsGroupSaveResults', groups)
+        return out
+
+    def _check_save_results(self, out, result_key, objects):
+        if 'WsRestResultProblem' in out:
+            meta = out['WsRestResultProblem']['resultMetadata']
+            raise Exception(meta)
+        results = out.get(result_key, {}).get('results', [])
+        for (name, _), result in zip(objects, results):
+            code = result['resultMetadata']['resultCode']
+            if code not in ['SUCCESS_INSERTED', 'SUCCESS_UPDATED',
+                'SUCCESS_NO_CHANGES_NEEDED']:
+                msg = result['resultMetadata'].get('resultMessage', '')
+                raise Exception(f'{name}: {code}: {msg}')
+
+    def replace_users(self, group, users):
+        '''Replace the members of the grouper group {group} with {users}.'''
+        logger.info('transferring to {}'.format(group))
+        return self._add_members(group, user_lookups(users), replace=True)
+
+    def add_members(self, group, users):
+        '''Add {users} to the grouper group {group}.'''
+        logger.info('adding {} members to {}'.format(len(users), group))
+        return self._add_members(group, user_lookups(users), replace=False)
+
+    def add_groups(self, group, member_groups):
+        '''Add the grouper groups {member_groups} to {group} as members.'''
+        logger.info('adding {} groups to {}'.format(len(member_groups), group))
+        return self._add_members(group, group_lookups(member_groups),
+            replace=False)
+
+    def _add_members(self, group, lookups, replace):
+        '''Add members in chunks of chunk_size. With {replace}, the first
+           chunk replaces the existing members and the rest are added to
+           it, so the group is partly populated until the last chunk.'''
+        # https://github.com/Internet2/grouper/blob/master/grouper-ws/grouper-ws/doc/samples/addMember/WsSampleAddMemberRest_json.txt
+        for i, chunk in enumerate(chunks(lookups, self.chunk_size or chunk_size)):
+            data = {
+                "WsRestAddMemberRequest": {
+                    "replaceAllExisting":"T" if replace and i == 0 else "F",
+                    "subjectLookups":chunk
+                }
+            }
+            out = self._request('PUT', f'groups/{group}/members', data)
+            if 'WsRestResultProblem' in out:
+                meta = out['WsRestResultProblem']['resultMetadata']
+                raise Exception(meta)
+        return out
+
+    def delete_members(self, group, users):
+        '''Remove {users} from the grouper group {group}.'''
+        logger.info('deleting {} members from {}'.format(len(users), group))
+        # https://github.com/Internet2/grouper/blob/master/grouper-ws/grouper-ws/doc/samples/deleteMember/WsSampleDeleteMemberRest_json.txt
+        for chunk in chunks(user_lookups(users), self.chunk_size or chunk_size):
+            data = {
+                "WsRestDeleteMemberRequest": {
+                    "subjectLookups":chunk
+                }
+            }
+            out = self._request('PUT', f'groups/{group}/members', data)
+            if 'WsRestResultProblem' in out:
+                meta = out['WsRestResultProblem']['resultMetadata']
+                raise Exception(meta)
+        return out
+
+    def get_members(self, group):
+        '''Return the set of subject ids of the immediate, non-group
+           members of the grouper group {group}.'''
+        logger.info('getting members of {}'.format(group))
+        # https://github.com/Internet2/grouper/blob/master/grouper-ws/grouper-ws/doc/samples/getMembers/WsSampleGetMembersRest_json.txt
+        data = {
+            "WsRestGetMembersRequest": {
+                "wsGroupLookups":[{"groupName":group}],
+                "memberFilter":"Immediate",
+                "includeSubjectDetail":"F"
+            }
         }
-    }
-    for user in users:
-        data['WsRestAddMemberRequest']['subjectLookups'].append(
-            {"subjectId":user}
-        )
-    r = requests.put(f'{base_uri}/groups/{group}/members',
-        data=json.dumps(data), auth=auth, headers={'Content-type':'text/x-json'}
-    )
-    out = r.json()
-    if 'WsRestResultProblem' in out:
-        msg = out['WsRestResultProblem']['resultMetadata']['resultMessage']
-        meta = out['WsRestResultProblem']['resultMetadata']
-        raise Exception(meta)
+        out = self._request('POST', 'groups', data)
+        if 'WsRestResultProblem' in out:
+            meta = out['WsRestResultProblem']['resultMetadata']
+            raise Exception(meta)
+        results = out['WsGetMembersResults']['results'][0]
+        code = results['resultMetadata']['resultCode']
+        if code != 'SUCCESS':
+            msg = results['resultMetadata'].get('resultMessage', '')
+            raise Exception(f'{code}: {msg}')
+        subjects = results.get('wsSubjects', [])
+        return set(s['id'] for s in subjects
+            if s.get('sourceId') != group_source)
@@ -0,0 +1,102 @@
+# vim:set et sw=4 ts=4:
+import hashlib
+import logging
+import sqlite3
+import sys
+import threading
+import time
+
+# logging
+logging.basicConfig(stream=sys.stdout, level=logging.WARNING)
+logger = logging.getLogger(__name__)
+
+def uid_hash(uids):
+    '''Return a digest of a set of uids that does not depend on order.'''
+    return hashlib.sha256('\n'.join(sorted(uids)).encode()).hexdigest()
+
+class Journal:
+    '''An SQLite journal of multi-course runs. It records which phases of
+       each course completed in each run, and the hash of the uids last
+       pushed to each subgroup, so that an interrupted run can be resumed
+       and unchanged subgroups need not be written again. Courses are keyed
+       by their course group, e.g. edu:dept:classes:...-2192-stat-243.'''
+
+    def __init__(self, path):
+        self.path = path
+        self.run_id = None
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.executescript('''
+            create table if not exists runs (
+                run_id integer primary key, started real, finished real);
+            create table if not exists phases (
+                run_id integer, course text, phase text, at real,
+                primary key (run_id, course, phase));
+            create table if not exists pushes (
+                course text, subgroup text, hash text, at real,
+                primary key (course, subgroup));
+        ''')
+        self._db.commit()
+
+    def start_run(self, resume=False):
+        '''Start a new run, or with {resume} continue the last unfinished
+           one. Returns the run id.'''
+        with self._lock:
+            row = None
+            if resume:
+                row = self._db.execute('''select run_id from runs where
+                    finished is null order by run_id desc limit 1''').fetchone()
+            if row is not None:
+                self.run_id = row[0]
+                logger.info(f'resuming run {self.run_id}')
+            else:
+                cursor = self._db.execute(
+                    'insert into runs (started) values (?)', (time.time(),))
+                self.run_id = cursor.lastrowid
+            self._db.commit()
+        return self.run_id
+
+    def finish_run(self):
+        with self._lock:
+            self._db.execute('update runs set finished = ? where run_id = ?',
+                (time.time(), self.run_id))
+            self._db.commit()
+
+    def record(self, course, phase):
+        '''Record that a course completed a phase in this run.'''
+        with self._lock:
+            self._db.execute('''insert or replace into phases
+                (run_id, course, phase, at) values (?, ?, ?, ?)''',
+                (self.run_id, course, phase, time.time()))
+            self._db.commit()
+
+    def completed(self, course, phase='done'):
+        '''Return whether a course completed a phase in this run.'''
+        with self._lock:
+            row = self._db.execute('''select 1 from phases where
+                run_id = ? and course = ? and phase = ?''',
+                (self.run_id, course, phase)).fetchone()
+        return row is not None
+
+    def pushed(self, course, subgroup):
+        '''Return the hash of the uids last pushed to a subgroup, or None.'''
+        with self._lock:
+            row = self._db.execute('''select hash from pushes where
+                course = ? and subgroup = ?''', (course, subgroup)).fetchone()
+        return row[0] if row else None
+
+    def unchanged(self, course, subgroup, uids):
+        '''Return whether {uids} are those last pushed to a subgroup.'''
+        return self.pushed(course, subgroup) == uid_hash(uids)
+
+    def record_push(self, course, subgroup, uids):
+        '''Record that a subgroup's members were set to {uids}.'''
+        with self._lock:
+            self._db.execute('''insert or replace into pushes
+                (course, subgroup, hash, at) values (?, ?, ?, ?)''',
+                (course, subgroup, uid_hash(uids), time.time()))
+            self._db.commit()
+
+    def close(self):
+        with self._lock:
+            self._db.close()
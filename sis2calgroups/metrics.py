@@ -0,0 +1,161 @@
+# vim:set et sw=4 ts=4:
+import collections
+import contextlib
+import contextvars
+import functools
+import json
+import logging
+import os
+import sys
+import threading
+import time
+
+# logging
+logging.basicConfig(stream=sys.stdout, level=logging.WARNING)
+logger = logging.getLogger(__name__)
+
+# upper bounds, in seconds, of the request latency histogram buckets
+buckets = [0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, float('inf')]
+
+# the course that outbound requests are made on behalf of
+current_course = contextvars.ContextVar('current_course', default='')
+
+def submit(pool, func, *args, **kwargs):
+    '''Submit func to an executor so that it runs with the caller's context,
+       in particular the current course.'''
+    context = contextvars.copy_context()
+    return pool.submit(context.run, func, *args, **kwargs)
+
+class Metrics:
+    '''Counts, latency histograms, bytes, status codes and retries of
+       outbound requests by api, endpoint and course, and the time spent in
+       each phase of a course sync.'''
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.requests = collections.defaultdict(lambda: {
+            'count': 0, 'seconds': 0.0, 'buckets': [0] * len(buckets),
+            'bytes_sent': 0, 'bytes_received': 0, 'retries': 0,
+            'statuses': collections.Counter()
+        })
+        self.phases = collections.defaultdict(lambda: {
+            'count': 0, 'seconds': 0.0})
+        self.gauges = {}
+
+    def record(self, api, endpoint, status, seconds, bytes_sent=0,
+        bytes_received=0, retries=0):
+        '''Record one outbound request.'''
+        key = (api, endpoint, current_course.get())
+        with self._lock:
+            r = self.requests[key]
+            r['count'] += 1
+            r['seconds'] += seconds
+            for i, bound in enumerate(buckets):
+                if seconds <= bound:
+                    r['buckets'][i] += 1
+            r['bytes_sent'] += bytes_sent
+            r['bytes_received'] += bytes_received
+            r['retries'] += retries
+            r['statuses'][str(status)] += 1
+
+    @contextlib.contextmanager
+    def span(self, phase):
+        '''Time a phase (e.g. fetch, provision, populate) of a course sync.'''
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            seconds = time.perf_counter() - start
+            with self._lock:
+                p = self.phases[(phase, current_course.get())]
+                p['count'] += 1
+                p['seconds'] += seconds
+
+    def timed(self, phase, func):
+        '''Wrap func so that each call is timed as {phase}.'''
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with self.span(phase):
+                return func(*args, **kwargs)
+        return wrapper
+
+    def set_gauge(self, name, value):
+        with self._lock:
+            self.gauges[name] = value
+
+    def summary(self):
+        '''Return the metrics as a JSON-serializable dict.'''
+        with self._lock:
+            requests = [dict(api=api, endpoint=endpoint, course=course,
+                    count=r['count'], seconds=round(r['seconds'], 6),
+                    buckets=dict(zip(map(str, buckets), r['buckets'])),
+                    bytes_sent=r['bytes_sent'],
+                    bytes_received=r['bytes_received'],
+                    retries=r['retries'], statuses=dict(r['statuses']))
+                for (api, endpoint, course), r in self.requests.items()]
+            phases = [dict(phase=phase, course=course, count=p['count'],
+                    seconds=round(p['seconds'], 6))
+                for (phase, course), p in self.phases.items()]
+            return {'requests': requests, 'phases': phases,
+                'gauges': dict(self.gauges)}
+
+    def prometheus(self):
+        '''Return the metrics in the Prometheus text exposition format.'''
+        def labels(**kwargs):
+            return '{' + ','.join(f'{k}="{v}"' for k, v in kwargs.items()) + '}'
+
+        summary = self.summary()
+        lines = []
+        lines.append('# TYPE sis2calgroups_requests_total counter')
+        for r in summary['requests']:
+            for status, count in r['statuses'].items():
+                l = labels(api=r['api'], endpoint=r['endpoint'],
+                    course=r['course'], status=status)
+                lines.append(f'sis2calgroups_requests_total{l} {count}')
+        lines.append('# TYPE sis2calgroups_request_seconds histogram')
+        for r in summary['requests']:
+            tags = dict(api=r['api'], endpoint=r['endpoint'],
+                course=r['course'])
+            for bound, count in r['buckets'].items():
+                le = '+Inf' if bound == 'inf' else bound
+                l = labels(le=le, **tags)
+                lines.append(f'sis2calgroups_request_seconds_bucket{l} {count}')
+            l = labels(**tags)
+            lines.append(f"sis2calgroups_request_seconds_sum{l} {r['seconds']}")
+            lines.append(f"sis2calgroups_request_seconds_count{l} {r['count']}")
+        lines.append('# TYPE sis2calgroups_request_bytes_total counter')
+        for r in summary['requests']:
+            for direction in ['sent', 'received']:
+                l = labels(api=r['api'], endpoint=r['endpoint'],
+                    course=r['course'], direction=direction)
+                value = r[f'bytes_{direction}']
+                lines.append(f'sis2calgroups_request_bytes_total{l} {value}')
+        lines.append('# TYPE sis2calgroups_request_retries_total counter')
+        for r in summary['requests']:
+            l = labels(api=r['api'], endpoint=r['endpoint'],
+                course=r['course'])
+            lines.append(
+                f"sis2calgroups_request_retries_total{l} {r['retries']}")
+        lines.append('# TYPE sis2calgroups_phase_seconds_total counter')
+        for p in summary['phases']:
+            l = labels(phase=p['phase'], course=p['course'])
+            lines.append(f"sis2calgroups_phase_seconds_total{l} {p['seconds']}")
+        for name, value in summary['gauges'].items():
+            lines.append(f'# TYPE sis2calgroups_{name} gauge')
+            lines.append(f'sis2calgroups_{name} {value}')
+        return '\n'.join(lines) + '\n'
+
+    def write(self, path):
+        '''Write the metrics to {path}, as a Prometheus textfile if it ends
+           in .prom and as JSON otherwise.'''
+        if path.endswith('.prom'):
+            text = self.prometheus()
+        else:
+            text = json.dumps(self.summary(), indent=1)
+        tmp = path + '.tmp'
+        with open(tmp, 'w') as f:
+            f.write(text)
+        os.replace(tmp, path)
+
+# metrics shared by every request in a run
+registry = Metrics()
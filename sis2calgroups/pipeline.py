@@ -0,0 +1,49 @@
+# vim:set et sw=4 ts=4:
+import concurrent.futures
+import logging
+import sys
+
+from sis2calgroups import metrics
+
+# logging
+logging.basicConfig(stream=sys.stdout, level=logging.WARNING)
+logger = logging.getLogger(__name__)
+
+def run_tasks(tasks, workers=4):
+    '''Run a graph of tasks concurrently and return a dict of their results.
+
+       {tasks} maps a task name to a (func, deps) tuple. Once every task named
+       in deps has finished, func is called with their results as keyword
+       arguments named after them. If a task fails, tasks that have not yet
+       started are cancelled and the exception is raised.'''
+    for name, (func, deps) in tasks.items():
+        unknown = set(deps) - set(tasks)
+        if unknown:
+            raise Exception(f'Task {name} depends on unknown tasks {unknown}')
+    results = {}
+    waiting = dict(tasks)
+    running = {}
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as pool:
+        while waiting or running:
+            # start every task whose dependencies are done
+            for name, (func, deps) in list(waiting.items()):
+                if all(dep in results for dep in deps):
+                    kwargs = {dep: results[dep] for dep in deps}
+                    logger.debug(f'starting {name}')
+                    running[metrics.submit(pool, func, **kwargs)] = name
+                    del waiting[name]
+            if not running:
+                raise Exception(
+                    f'Tasks have circular dependencies: {list(waiting)}')
+            done, _ = concurrent.futures.wait(running,
+                return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                name = running.pop(future)
+                try:
+                    results[name] = future.result()
+                except Exception:
+                    for other in running:
+                        other.cancel()
+                    raise
+                logger.debug(f'finished {name}')
+    return results
@@ -0,0 +1,93 @@
+# vim:set et sw=4 ts=4:
+import email.utils
+import logging
+import random
+import sys
+import threading
+import time
+
+# logging
+logging.basicConfig(stream=sys.stdout, level=logging.WARNING)
+logger = logging.getLogger(__name__)
+
+# responses that mean we are sending too much and should back off
+throttle_statuses = [429, 503]
+
+def retry_after(response):
+    '''Return the seconds to wait from a response's Retry-After header, which
+       is either a number of seconds or an HTTP date, or None.'''
+    value = response.headers.get('Retry-After')
+    if value is None:
+        return None
+    if value.strip().isdigit():
+        return float(value)
+    try:
+        when = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max(0, when.timestamp() - time.time())
+
+class RateLimiter:
+    '''A token bucket shared by every thread that calls an API. Requests
+       are sent at up to {rate} per second with bursts of up to {burst}.
+       When the API throttles us (429 or 503) the rate is halved and every
+       caller waits for the Retry-After period, or a jittered exponential
+       backoff if there is none; the rate then recovers with each success.'''
+
+    def __init__(self, rate, burst=None, max_retries=5, backoff=1,
+        max_backoff=60):
+        self.max_rate = rate
+        self.rate = rate
+        self.burst = burst or max(1, int(rate))
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+        self.blocked_until = 0
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        '''Block until a request may be sent.'''
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self.tokens = min(self.burst,
+                    self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if now >= self.blocked_until and self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = max(self.blocked_until - now,
+                    (1 - self.tokens) / self.rate)
+            time.sleep(wait)
+
+    def throttled(self, attempt, delay=None):
+        '''Slow down after the API throttled us on the {attempt}th try.'''
+        if delay is None:
+            delay = min(self.max_backoff, self.backoff * 2 ** attempt)
+            delay = delay / 2 + random.uniform(0, delay / 2)
+        with self._lock:
+            self.rate = max(self.max_rate / 64, self.rate / 2)
+            self.blocked_until = max(self.blocked_until,
+                time.monotonic() + delay)
+        logger.info(f'throttled, waiting {delay:.1f}s at {self.rate:.2f}/s')
+
+    def succeeded(self):
+        with self._lock:
+            self.rate = min(self.max_rate, self.rate + self.max_rate / 20)
+
+    def call(self, send):
+        '''Call send(attempt), which returns a requests.Response, within the
+           rate limit, retrying while the API throttles us. {attempt} counts
+           from 0, so that retries can be told apart from first tries.
+           Returns the last response.'''
+        for attempt in range(self.max_retries + 1):
+            self.acquire()
+            r = send(attempt)
+            if r.status_code not in throttle_statuses:
+                self.succeeded()
+                return r
+            if attempt < self.max_retries:
+                self.throttled(attempt, retry_after(r))
+        return r
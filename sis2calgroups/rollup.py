@@ -0,0 +1,86 @@
+# vim:set et sw=4 ts=4:
+import collections
+import logging
+import sys
+import threading
+
+from sis2calgroups import calgroups
+
+# logging
+logging.basicConfig(stream=sys.stdout, level=logging.WARNING)
+logger = logging.getLogger(__name__)
+
+# roles that are not rolled up: non-enrolled is not sourced from SIS and
+# "all" is derived from the others
+excluded_roles = ['all', 'non-enrolled']
+
+class UidIndex:
+    '''The courses and roles of every uid seen in a term, built as courses
+       are synced so that department-wide groups can be derived from it
+       rather than reconstructed from Grouper. Maps uid to a set of
+       (subject_area, catalog_number, role) tuples.'''
+
+    def __init__(self):
+        self.memberships = collections.defaultdict(set)
+        self._lock = threading.Lock()
+
+    def add(self, subject_area, catalog_number, uids):
+        '''Index a course's uids, a dict of role (subgroup) to uids.'''
+        with self._lock:
+            for role, members in uids.items():
+                for uid in members:
+                    self.memberships[uid].add(
+                        (subject_area, catalog_number, role))
+
+    def subject_areas(self):
+        with self._lock:
+            return sorted(set(sa for memberships in self.memberships.values()
+                for sa, cn, role in memberships))
+
+    def members(self, subject_area, roles):
+        '''Return the uids with any of {roles} in any course of a subject
+           area.'''
+        with self._lock:
+            return set(uid for uid, memberships in self.memberships.items()
+                if any(sa == subject_area and role in roles
+                    for sa, cn, role in memberships))
+
+    def rollups(self, subject_area, subgroups):
+        '''Return a dict of rollup group name to uids for a subject area,
+           e.g. astron-enrolled for every student enrolled in an ASTRON
+           course. astron-all, which like a course's "all" group is kept
+           whatever the subgroups, has everyone in an ASTRON course but
+           those who dropped.'''
+        roles = [s for s in subgroups if s not in excluded_roles]
+        groups = {f'{subject_area}-{role}':
+            self.members(subject_area, [role]) for role in roles}
+        groups[f'{subject_area}-all'] = self.members(subject_area,
+            [role for role in roles if role != 'dropped'])
+        return groups
+
+def create_rollup_groups(grouper_client, base_group, term_id, rollups,
+    max_churn=calgroups.max_churn, journal=None):
+    '''Create and populate rollup groups, a dict of name to uids, in the
+       term stem. With a journal.Journal, groups whose uids are unchanged
+       since they were last pushed are not written. Returns the number of
+       membership changes.'''
+    # term ~ {base_group}:stat-classes-2188
+    term_group = calgroups.child_id(base_group, term_id)
+    groups = {calgroups.child_id(term_group, name): name for name in rollups}
+    missing = calgroups.structure_index.missing(groups)
+    if missing:
+        logger.info(f'creating rollup groups {missing}')
+        grouper_client.save_groups([(group, groups[group])
+            for group in missing])
+        calgroups.structure_index.add(missing)
+
+    changes = 0
+    for name, uids in rollups.items():
+        if journal is not None and journal.unchanged(term_group, name, uids):
+            logger.info(f'{term_group} {name} is unchanged')
+            continue
+        changes += calgroups.sync_group(grouper_client, term_group, name,
+            uids, max_churn)
+        if journal is not None:
+            journal.record_push(term_group, name, uids)
+    return changes
@@ -0,0 +1,210 @@
+# vim:set et sw=4 ts=4:
+import bisect
+import concurrent.futures
+import hashlib
+import logging
+import sqlite3
+import sys
+import threading
+import time
+
+from sis2calgroups import daemon
+
+# logging
+logging.basicConfig(stream=sys.stdout, level=logging.WARNING)
+logger = logging.getLogger(__name__)
+
+# seconds that a worker's heartbeat and leases last without being renewed
+lease_ttl = 60
+
+# seconds to wait before looking for work again when there is none to claim
+poll_interval = 5
+
+def _hash(key):
+    return int(hashlib.sha1(key.encode()).hexdigest()[:16], 16)
+
+class HashRing:
+    '''A consistent hash ring of workers. Each worker is placed on the ring
+       {replicas} times so that courses are spread evenly, and when a
+       worker joins or leaves only the courses next to it change hands.'''
+
+    def __init__(self, workers, replicas=64):
+        self.ring = sorted((_hash(f'{worker}:{i}'), worker)
+            for worker in workers for i in range(replicas))
+        self.points = [point for point, worker in self.ring]
+
+    def owner(self, key):
+        '''Return the worker that owns {key}, or None if there are none.'''
+        if not self.ring:
+            return None
+        i = bisect.bisect(self.points, _hash(key)) % len(self.ring)
+        return self.ring[i][1]
+
+class LeaseStore:
+    '''Worker heartbeats, course leases and course completions shared by
+       the workers of a sharded run. This stand-in keeps them in an SQLite
+       file, which every worker must be able to lock, e.g. on one host or
+       a shared filesystem with working locks. Workers' clocks must agree to
+       well within {ttl} seconds.'''
+
+    def __init__(self, path, ttl=lease_ttl):
+        self.path = path
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, timeout=30, isolation_level=None,
+            check_same_thread=False)
+        self._db.executescript('''
+            create table if not exists workers (
+                run text, worker text, heartbeat real,
+                primary key (run, worker));
+            create table if not exists leases (
+                course text primary key, worker text, expires real);
+            create table if not exists completions (
+                run text, course text, worker text, error text, at real,
+                primary key (run, course));
+        ''')
+
+    def heartbeat(self, run, worker):
+        '''Mark {worker} live in {run} and renew the leases that it still
+           holds.'''
+        now = time.time()
+        with self._lock:
+            self._db.execute('begin immediate')
+            self._db.execute('insert or replace into workers values '
+                '(?, ?, ?)', (run, worker, now))
+            self._db.execute('''update leases set expires = ? where
+                worker = ? and expires >= ?''', (now + self.ttl, worker, now))
+            self._db.execute('commit')
+
+    def leave(self, run, worker):
+        '''Remove {worker} from {run} so that its courses rebalance right
+           away.'''
+        with self._lock:
+            self._db.execute('begin immediate')
+            self._db.execute('delete from workers where run = ? and '
+                'worker = ?', (run, worker))
+            self._db.execute('delete from leases where worker = ?', (worker,))
+            self._db.execute('commit')
+
+    def live_workers(self, run):
+        '''Return the workers of {run} that are heartbeating. Workers of
+           other runs sharing the store are not included.'''
+        with self._lock:
+            rows = self._db.execute('select worker from workers where '
+                'run = ? and heartbeat >= ?',
+                (run, time.time() - self.ttl)).fetchall()
+        return [row[0] for row in rows]
+
+    def acquire(self, course, worker):
+        '''Lease {course} to {worker} unless another worker holds an
+           unexpired lease on it. Returns whether the lease was acquired.'''
+        now = time.time()
+        with self._lock:
+            self._db.execute('begin immediate')
+            try:
+                row = self._db.execute('select worker, expires from leases '
+                    'where course = ?', (course,)).fetchone()
+                if row is not None and row[0] != worker and row[1] >= now:
+                    return False
+                self._db.execute('insert or replace into leases values '
+                    '(?, ?, ?)', (course, worker, now + self.ttl))
+                return True
+            finally:
+                self._db.execute('commit')
+
+    def complete(self, run, course, worker, error=None):
+        '''Record that {worker} finished {course} in {run}, successfully or
+           with {error}, and release its lease.'''
+        with self._lock:
+            self._db.execute('begin immediate')
+            self._db.execute('insert or replace into completions values '
+                '(?, ?, ?, ?, ?)', (run, course, worker,
+                    None if error is None else str(error), time.time()))
+            self._db.execute('delete from leases where course = ? and '
+                'worker = ?', (course, worker))
+            self._db.execute('commit')
+
+    def completed(self, run):
+        '''Return the courses finished in {run}.'''
+        with self._lock:
+            rows = self._db.execute('select course from completions where '
+                'run = ?', (run,)).fetchall()
+        return set(row[0] for row in rows)
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+def run(sync, courses, store, worker, run_id, workers=4):
+    '''Sync this worker's share of {courses} in the run {run_id} with
+       {workers} threads. Courses are assigned to the live workers by
+       consistent hashing and each is leased before it is synced, so no
+       course is synced by two workers at once. When a worker stops
+       heartbeating, its courses pass to the others once its leases expire.
+       Returns a dict of the (subject_area, catalog_number) courses that
+       this worker synced -> exception, or None for those that succeeded.'''
+    keys = {daemon.course_key(*course): course for course in courses}
+    results = {}
+    in_progress = set()
+    lock = threading.Lock()
+    stop = threading.Event()
+
+    def heartbeat():
+        while not stop.wait(store.ttl / 3):
+            try:
+                store.heartbeat(run_id, worker)
+            except Exception as e:
+                logger.error(f'heartbeat failed: {e}')
+
+    def claim():
+        '''Lease a pending course that this worker owns. Returns the
+           course, None if there is none now, or False if the run is
+           finished.'''
+        with lock:
+            done = store.completed(run_id)
+            pending = [key for key in keys if key not in done]
+            if not pending:
+                return False
+            ring = HashRing(store.live_workers(run_id))
+            for key in pending:
+                if key in in_progress or ring.owner(key) != worker:
+                    continue
+                if store.acquire(key, worker):
+                    in_progress.add(key)
+                    return key
+            return None
+
+    def work():
+        while True:
+            key = claim()
+            if key is False:
+                return
+            if key is None:
+                time.sleep(poll_interval)
+                continue
+            course = keys[key]
+            error = None
+            try:
+                sync(*course)
+                logger.info(f'{course[0]} {course[1]}: ok')
+            except Exception as e:
+                error = e
+                logger.error(f'{course[0]} {course[1]}: {e}')
+            store.complete(run_id, key, worker, error)
+            with lock:
+                in_progress.discard(key)
+                results[course] = error
+
+    store.heartbeat(run_id, worker)
+    beat = threading.Thread(target=heartbeat, daemon=True)
+    beat.start()
+    try:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as pool:
+            for future in [pool.submit(work) for i in range(workers)]:
+                future.result()
+    finally:
+        stop.set()
+        store.leave(run_id, worker)
+    failed = len([e for e in results.values() if e is not None])
+    logger.info(f'{worker} synced {len(results)} courses, {failed} failed')
+    return results
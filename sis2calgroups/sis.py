@@ -1,8 +1,18 @@
 # vim:set et sw=4 ts=4:
+import collections
+import concurrent.futures
+import datetime
+import json
 import logging
+import os
 import sys
+import threading
+import time
 
 import requests
+from requests.adapters import HTTPAdapter
+
+from sis2calgroups import metrics, ratelimit
 
 # logging
 logging.basicConfig(stream=sys.stdout, level=logging.WARNING)
@@ -15,6 +25,25 @@ sections_uri = enrollments_uri + "/terms/{}/classes/sections/{}"
 classes_sections_uri = "https://apis.berkeley.edu/sis/v1/classes/sections"
 terms_uri = "https://apis.berkeley.edu/sis/v1/terms"
 
+# number of pages to fetch concurrently once results are known to be paginated
+prefetch_pages = 4
+
+# a keep-alive session shared by all SIS requests
+session = requests.Session()
+session.mount('https://', HTTPAdapter(pool_maxsize=32))
+session.mount('http://', HTTPAdapter(pool_maxsize=32))
+
+# requests per second to the SIS, shared by all threads. API Central keys
+# are quota-limited.
+rate_limiter = ratelimit.RateLimiter(10)
+
+# an optional cache.ResponseCache shared by all SIS requests
+response_cache = None
+
+# an optional TermIndex shared by all term lookups
+term_index = None
+_term_index_lock = threading.Lock()
+
 # apparently some courses have LAB without LEC (?)
 section_codes = ['LEC', 'SES', 'WBL', 'LAB']
 
@@ -31,53 +60,239 @@ def filter_lectures(sections, relevant_codes=section_codes):
             codes.append(section['code'])
     return codes
 
-def get_items(uri, params, headers, item_type):
-    '''Recursively get a list of items (enrollments, ) from the SIS.'''
-    r = requests.get(uri, params=params, headers=headers)
+def endpoint_name(uri):
+    '''Return the name of the SIS endpoint of {uri}, e.g. "enrollments".'''
+    for endpoint in ['descriptors', 'enrollments', 'classes', 'terms']:
+        if endpoint in uri:
+            return endpoint
+    return 'other'
+
+def get_json(uri, params, headers):
+    '''Get a response from the SIS, consulting response_cache if one is set.
+       Returns None if the SIS returned 404.'''
+    entry = None
+    if response_cache is not None:
+        entry = response_cache.get(uri, params)
+        if entry is not None and entry.fresh:
+            return json.loads(entry.body)
+        if entry is not None:
+            # revalidate a stale entry
+            headers = dict(headers)
+            if entry.etag:
+                headers['If-None-Match'] = entry.etag
+            if entry.last_modified:
+                headers['If-Modified-Since'] = entry.last_modified
+
+    def send(attempt):
+        start = time.perf_counter()
+        r = session.get(uri, params=params, headers=headers)
+        metrics.registry.record('sis', endpoint_name(uri), r.status_code,
+            time.perf_counter() - start, bytes_received=len(r.content),
+            retries=1 if attempt else 0)
+        return r
+
+    r = rate_limiter.call(send)
+    if r.status_code == 304 and entry is not None:
+        response_cache.touch(uri, params)
+        return json.loads(entry.body)
     if r.status_code == 404:
-        return []
+        return None
+    if r.status_code in ratelimit.throttle_statuses or r.status_code >= 400:
+        # do not mistake an unavailable SIS, or one that refused us (e.g.
+        # bad credentials), for an empty roster
+        raise Exception(f'{r.status_code} {r.reason} from {uri}')
     data = r.json()
+    # only successful responses are cached
+    if response_cache is not None and r.status_code == 200:
+        response_cache.put(uri, params, r.text, r.headers.get('ETag'),
+            r.headers.get('Last-Modified'))
+    return data
+
+def get_page(uri, params, headers, item_type):
+    '''Get a single page of items (enrollments, ) from the SIS.'''
+    data = get_json(uri, params, headers)
+    if data is None:
+        return []
     # Return if there is no response (e.g. 404)
     if 'response' not in data['apiResponse']:
         logger.debug('404 No response')
-        return[]
+        return []
     # Return if the UID has no items
     elif item_type not in data['apiResponse']['response']:
         logger.debug('No {}'.format(item_type))
         return []
-    # Get this page's items
-    items = data['apiResponse']['response'][item_type]
-    # If we are not paginated, just return the items
+    return data['apiResponse']['response'][item_type]
+
+def iter_pages(uri, params, headers, item_type, prefetch=None):
+    '''Yield each page of items from the SIS in order. Iteration stops at
+       the first empty (or 404) page. While pages come back full, so that
+       more are likely, up to {prefetch} of the following pages are fetched
+       concurrently (default: prefetch_pages); otherwise pages are fetched
+       one at a time. A short page does not end the iteration, since the
+       SIS may serve fewer items per page than were asked for. {params} is
+       not modified.'''
+    if prefetch is None:
+        prefetch = prefetch_pages
+    prefetch = max(prefetch, 1)
+
+    def full(items):
+        return 'page-size' in params and len(items) >= params['page-size']
+
+    items = get_page(uri, params, headers, item_type)
+    if not items:
+        return
+    yield items
+    # If we are not paginated, we are done
     if 'page-number' not in params:
-        return items
-    # Get the next page's items
-    params['page-number'] += 1
-    items += get_items(uri, params, headers, item_type)
+        return
+
+    def page_params(page_number):
+        return dict(params, **{'page-number': page_number})
+
+    next_page = params['page-number'] + 1
+    pool = concurrent.futures.ThreadPoolExecutor(max_workers=prefetch)
+    pending = collections.deque()
+    try:
+        for i in range(prefetch if full(items) else 1):
+            pending.append(metrics.submit(pool, get_page, uri,
+                page_params(next_page), headers, item_type))
+            next_page += 1
+        while pending:
+            items = pending.popleft().result()
+            if not items:
+                break
+            yield items
+            # keep the window topped up only while pages are full
+            if full(items) or not pending:
+                pending.append(metrics.submit(pool, get_page, uri,
+                    page_params(next_page), headers, item_type))
+                next_page += 1
+    finally:
+        # Drop any pages past the end that are still queued
+        for future in pending:
+            future.cancel()
+        pool.shutdown(wait=False)
+
+def get_items(uri, params, headers, item_type, prefetch=None):
+    '''Get a list of items (enrollments, ) from all pages of the SIS.'''
+    items = []
+    for page in iter_pages(uri, params, headers, item_type, prefetch):
+        items += page
     num = len(items)
     logger.debug(f'There are {num} items of type {item_type}')
     return items
 
-def get_term_name(app_id, app_key, term_id):
-    '''Given a term id, return the term's friendly name.'''
+def get_terms(app_id, app_key, position=None, term_id=None):
+    '''Return the SIS terms at a temporal position of Current, Previous, or
+       Next, or the term with id {term_id}.'''
     headers = {
         "Accept": "application/json",
         "app_id": app_id, "app_key": app_key
     }
-    uri = f'{terms_uri}/{term_id}'
-    terms = get_items(uri, params, headers, 'terms')
-    return terms[0]['name']
+    if term_id is not None:
+        uri = f'{terms_uri}/{term_id}'
+        params = {}
+    else:
+        uri = terms_uri
+        params = { "temporal-position": position or 'Current' }
+    return get_items(uri, params, headers, 'terms')
+
+class TermIndex:
+    '''An in-memory map of temporal positions to term ids and of term ids
+       to friendly names, so that each is fetched from the SIS at most once.
+       If {path} is given the index is persisted there between runs.
+       Positions expire at the end of the current term; names never do.'''
+
+    def __init__(self, app_id, app_key, path=None):
+        self.app_id = app_id
+        self.app_key = app_key
+        self.path = path
+        self.positions = {}
+        self.names = {}
+        self.expires = 0
+        self._lock = threading.Lock()
+        if path and os.path.exists(path):
+            with open(path) as f:
+                data = json.load(f)
+            self.names = data.get('names', {})
+            if data.get('expires', 0) > time.time():
+                self.positions = data.get('positions', {})
+                self.expires = data['expires']
+
+    def _add_terms(self, terms):
+        for term in terms:
+            self.names[str(term['id'])] = term['name']
+
+    def _end_of_term(self, term):
+        '''Return the timestamp of the day after {term} ends.'''
+        try:
+            end = datetime.datetime.strptime(term['endDate'], '%Y-%m-%d')
+        except (KeyError, ValueError):
+            # we do not know when the term ends, so check again tomorrow
+            return time.time() + 24 * 3600
+        return (end + datetime.timedelta(days=1)).timestamp()
+
+    def _load_current(self):
+        terms = get_terms(self.app_id, self.app_key, 'Current')
+        self._add_terms(terms)
+        self.positions['Current'] = str(terms[0]['id'])
+        self.expires = self._end_of_term(terms[0])
+
+    def term_id(self, position='Current'):
+        '''Given a temporal position of Current, Previous, or Next, return
+           the corresponding term's ID.'''
+        position = position or 'Current'
+        with self._lock:
+            if time.time() >= self.expires:
+                self.positions = {}
+                self._load_current()
+                self.save()
+            if position not in self.positions:
+                terms = get_terms(self.app_id, self.app_key, position)
+                self._add_terms(terms)
+                self.positions[position] = str(terms[0]['id'])
+                self.save()
+            return self.positions[position]
+
+    def term_name(self, term_id):
+        '''Given a term id, return the term's friendly name.'''
+        term_id = str(term_id)
+        with self._lock:
+            if term_id not in self.names:
+                terms = get_terms(self.app_id, self.app_key, term_id=term_id)
+                self._add_terms(terms)
+                self.save()
+            return self.names[term_id]
+
+    def save(self):
+        if not self.path:
+            return
+        data = {
+            'positions': self.positions, 'names': self.names,
+            'expires': self.expires
+        }
+        tmp = self.path + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(data, f)
+        os.replace(tmp, self.path)
+
+def get_term_index(app_id, app_key):
+    '''Return the shared term_index, creating an in-memory one if none
+       has been set.'''
+    global term_index
+    with _term_index_lock:
+        if term_index is None:
+            term_index = TermIndex(app_id, app_key)
+        return term_index
+
+def get_term_name(app_id, app_key, term_id):
+    '''Given a term id, return the term's friendly name.'''
+    return get_term_index(app_id, app_key).term_name(term_id)
 
 def get_term_id(app_id, app_key, position='Current'):
     '''Given a temporal position of Current, Previous, or Next, return
        the corresponding term's ID.'''
-    headers = {
-        "Accept": "application/json",
-        "app_id": app_id, "app_key": app_key
-    }
-    params = { "temporal-position": position }
-    uri = terms_uri
-    terms = get_items(uri, params, headers, 'terms')
-    return terms[0]['id']
+    return get_term_index(app_id, app_key).term_id(position)
 
 def normalize_term_id(app_id, app_key, sis_term_id):
     '''Convert temporal position (current, next, previous) to a numeric term id,
@@ -126,6 +341,32 @@ def get_enrollments(e_id, e_key, term_id, subject_area, catalog_number):
     logger.info('{} {}'.format(catalog_number, len(enrollments)))
     return enrollments
 
+def iter_enrollments(e_id, e_key, term_id, subject_area, catalog_number,
+    emails=False, lecture_codes=None):
+    '''Yield a course's enrollments from the SIS as compact Enrollment
+       records while the pages arrive. The full documents are discarded.
+       If {lecture_codes} is not given it is looked up in the SIS. Any
+       section ids may be given to fetch the rosters of secondary sections
+       too; each record notes the section that it was fetched from.'''
+    logger.debug("iter_enrollments: {}".format(catalog_number))
+
+    # get the lectures
+    if lecture_codes is None:
+        lecture_codes = get_lecture_section_ids(e_id, e_key, term_id,
+                            subject_area, catalog_number)
+
+    headers = { "Accept": "application/json", "app_id": e_id, "app_key": e_key }
+    params = {
+        "page-number": 1,
+        "page-size": 100,
+    }
+    for lecture_code in lecture_codes:
+        uri = sections_uri.format(term_id, lecture_code)
+        for page in iter_pages(uri, params, headers,
+                'classSectionEnrollments'):
+            for enrollment in page:
+                yield Enrollment.from_sis(enrollment, emails, lecture_code)
+
 
 def filter_section_instructors(section):
     '''Extract the campus-uid of instructors from a section.'''
@@ -170,21 +411,78 @@ def get_sections(c_id, c_key, term_id, subject_area, catalog_number):
 def section_is_primary(section):
     return section['association']['primary']
 
-def get_enrollment_uids(enrollments):
+def section_catalog_number(section):
+    '''Return the catalog number of the course that a section belongs to.'''
+    return section['class']['course']['catalogNumber']['formatted'].upper()
+
+def get_subject_sections(c_id, c_key, term_id, subject_area):
+    '''Given a term and subject, return the sections of every course in the
+       subject in one paginated sweep.'''
+    logger.info(f'{term_id} {subject_area}')
+    headers = { "Accept": "application/json", "app_id": c_id, "app_key": c_key }
+    params = {
+        "subject-area-code": subject_area.upper(),
+        "term-id": term_id,
+        "page-size": 400,
+        "page-number": 1
+    }
+    return get_items(classes_sections_uri, params, headers, 'classSections')
+
+class SectionIndex:
+    '''A subject area's sections for a term, by catalog number and by
+       primary or secondary association, so that every course in the
+       subject can be synced from one sweep of the classes API.'''
+
+    def __init__(self, sections):
+        self.courses = collections.defaultdict(
+            lambda: {'primary': [], 'secondary': []})
+        for section in sections:
+            association = 'primary' if section_is_primary(section) \
+                else 'secondary'
+            catalog_number = section_catalog_number(section)
+            self.courses[catalog_number][association].append(section)
+
+    def catalog_numbers(self):
+        return sorted(self.courses)
+
+    def sections(self, catalog_number):
+        '''Return a course's sections, as get_sections does.'''
+        course = self.courses.get(catalog_number.upper())
+        if course is None:
+            return []
+        return course['primary'] + course['secondary']
+
+    def primary_ids(self, catalog_number):
+        '''Return the ids of a course's primary sections, whose enrollments
+           are a superset of those of its other sections.'''
+        course = self.courses.get(catalog_number.upper())
+        if course is None:
+            return []
+        return [str(section['id']) for section in course['primary']]
+
+def get_section_index(c_id, c_key, term_id, subject_area):
+    '''Return a SectionIndex of all of a subject's sections in a term.'''
+    return SectionIndex(get_subject_sections(c_id, c_key, term_id,
+        subject_area))
+
+def campus_uid(enrollment):
     '''Given an SIS enrollment, return the student's campus UID.'''
-    def campus_uid(enrollment):
-        for identifier in enrollment['student']['identifiers']:
-            if identifier['type'] == 'campus-uid':
-                return identifier['id']
+    for identifier in enrollment['student']['identifiers']:
+        if identifier['type'] == 'campus-uid':
+            return identifier['id']
+
+def campus_email(enrollment):
+    '''Given an SIS enrollment, return the student's campus email.'''
+    for email in enrollment['student'].get('emails', []):
+        if email['type']['code'] == 'CAMP': return email['emailAddress']
+    return None
+
+def get_enrollment_uids(enrollments):
+    '''Given SIS enrollments, return the students' campus UIDs.'''
     return list(map(lambda x: campus_uid(x), enrollments))
 
 def get_enrollment_emails(enrollments):
-    '''Given an SIS enrollment, return the student's campus email.'''
-    def campus_email(enrollment):
-        emails = {}
-        for email in enrollment['student'].get('emails', []):
-            if email['type']['code'] == 'CAMP': return email['emailAddress']
-        return None
+    '''Given SIS enrollments, return the students' campus emails.'''
     return list(map(lambda x: campus_email(x), enrollments))
 
 def enrollment_status(enrollment):
@@ -194,8 +492,45 @@ def enrollment_status(enrollment):
 def filter_enrollment_status(enrollments, status):
     return list(filter(lambda x: enrollment_status(x) == status, enrollments))
 
+class Enrollment:
+    '''The parts of an SIS enrollment that we use.'''
+    __slots__ = ('uid', 'status', 'email', 'section')
+
+    def __init__(self, uid, status, email=None, section=None):
+        self.uid = uid
+        self.status = status
+        self.email = email
+        self.section = section
+
+    @classmethod
+    def from_sis(cls, enrollment, emails=False, section=None):
+        email = campus_email(enrollment) if emails else None
+        return cls(campus_uid(enrollment), enrollment_status(enrollment), email,
+            section)
+
+def partition_enrollments(enrollments):
+    '''Bin Enrollment records by status in one pass. Returns a dict of
+       status ('E', 'W', 'D') -> set of uids.'''
+    statuses = collections.defaultdict(set)
+    for enrollment in enrollments:
+        statuses[enrollment.status].add(enrollment.uid)
+    return dict(statuses)
+
+def partition_sections(enrollments):
+    '''Bin Enrollment records by section and status in one pass. Returns
+       a dict of section id -> status -> set of uids.'''
+    sections = collections.defaultdict(lambda: collections.defaultdict(set))
+    for enrollment in enrollments:
+        sections[str(enrollment.section)][enrollment.status].add(
+            enrollment.uid)
+    return {section: dict(statuses) for section, statuses in sections.items()}
+
+def section_name(section):
+    '''Return a section's component and number, e.g. "lab-101".'''
+    return f"{section['component']['code']}-{section['number']}".lower()
+
 def all_group_name(app_id, app_key, subject_area, catalog_number, sis_term_id):
     '''Stat 243 Fall 2018'''
     # friendly name for the term, e.g. 2019 Fall
-    sis_term_name = sis.get_term_name(app_id, app_key, sis_term_id)
-    return f'{subject_area}.capitalize() {catalog_number} {sis_term_name}'
+    sis_term_name = get_term_name(app_id, app_key, sis_term_id)
+    return f'{subject_area.capitalize()} {catalog_number} {sis_term_name}'